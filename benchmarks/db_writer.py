@@ -0,0 +1,84 @@
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS_DIR = os.path.join(REPO_DIR, 'tests', 'defaults')
+sys.path.insert(0, REPO_DIR)
+# utils creates its data and log directories in the working directory on import.
+os.chdir(tempfile.mkdtemp(prefix='db_writer_'))
+
+import database
+import main
+from structures import ScreenerResponse, YHFinanceResponse
+
+FUNDS = 5000
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(DEFAULTS_DIR, name)) as fixture:
+        return json.load(fixture)
+
+
+def write_values(funds: int) -> list:
+    # Screener pages followed by one yh response per fund, the same shape db_master sees during a run.
+    screen_data = load_fixture('screen_data.json')
+    yh_data = load_fixture('yh_get_summary.json')
+    page_quotes = screen_data['finance']['result'][0]['quotes']
+    values = []
+    for start in range(0, funds, len(page_quotes)):
+        page = copy.deepcopy(screen_data)
+        quotes = page['finance']['result'][0]['quotes']
+        for i, quote in enumerate(quotes):
+            quote['symbol'] = f'F{start + i:06d}'
+        page['finance']['result'][0]['quotes'] = quotes[:funds - start]
+        values.append(ScreenerResponse(page))
+    for i in range(funds):
+        data = copy.deepcopy(yh_data)
+        data['symbol'] = f'F{i:06d}'
+        values.append(YHFinanceResponse(data))
+    return values
+
+
+def rows(values: list) -> int:
+    return sum(len(value.to_dict()['quotes']) if isinstance(value, ScreenerResponse) else 1 for value in values)
+
+
+def run_single(values: list) -> float:
+    # The previous writer: one transaction per value on a rollback journal.
+    db = database.DB('single.db')
+    db.connection.execute('PRAGMA journal_mode = DELETE;')
+    db.connection.execute('PRAGMA synchronous = FULL;')
+    db.create_tables()
+    start = time.perf_counter()
+    for value in values:
+        main.write_batch(db, [value], main.WriteChanges())
+    elapsed = time.perf_counter() - start
+    db.close_connections()
+    return elapsed
+
+
+def run_batched(values: list, batch_size: int) -> float:
+    db = database.DB('batched.db')
+    db.create_tables()
+    start = time.perf_counter()
+    for i in range(0, len(values), batch_size):
+        main.write_batch(db, values[i:i + batch_size], main.WriteChanges())
+    elapsed = time.perf_counter() - start
+    db.close_connections()
+    return elapsed
+
+
+if __name__ == '__main__':
+    funds = int(sys.argv[1]) if len(sys.argv) > 1 else FUNDS
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else main.utils.settings['db_batch_size']
+    values = write_values(funds)
+    total_rows = rows(values)
+    single = run_single(values)
+    batched = run_batched(values, batch_size)
+    print(f'{total_rows} rows from {len(values)} values')
+    print(f'per-value transactions: {single:.2f}s {total_rows / single:.0f} rows/s')
+    print(f'batches of {batch_size} (WAL): {batched:.2f}s {total_rows / batched:.0f} rows/s')
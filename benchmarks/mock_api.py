@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS_DIR = os.path.join(REPO_DIR, 'tests', 'defaults')
+
+FUNDS = 800
+HOST = '127.0.0.1'
+YH_PORT = 8101
+MS_PORT = 8102
+PAGE_SIZE = 50
+MAX_PRICE = 500
+RETRY_AFTER = 1
+# The quoteType the screener is asked for, as the pipeline sends it (utils.STATE_MUTUAL_FUND / STATE_ETF), and the
+# quoteType its quotes carry.
+SCREEN_QUOTE_TYPES = {'MUTUAL_FUND': 'MUTUALFUND', 'ETF': 'ETF'}
+
+
+def load_fixture(name: str):
+    with open(os.path.join(DEFAULTS_DIR, name)) as fixture:
+        return json.load(fixture)
+
+
+class Fund:
+    def __init__(self, symbol: str, quote_type: str, price: float, performance_id: str, star_rating: int,
+                 yh_bad: bool, ms_bad: bool):
+        self.symbol = symbol
+        self.quote_type = quote_type
+        self.price = price
+        self.performance_id = performance_id
+        self.star_rating = star_rating
+        self.yh_bad = yh_bad
+        self.ms_bad = ms_bad
+
+
+class Universe:
+    # A synthetic fund universe built from the fixtures in tests/defaults. Whether a fund is bad is decided once, so
+    # it fails the same way on every call, the way a real bad fund does.
+    def __init__(self, funds: int = FUNDS, bad_rate: float = 0, siblings: int = 0, seed: int = 0):
+        rng = random.Random(seed)
+        self.funds = []
+        for i in range(funds):
+            self.funds.append(Fund(f'F{i:06d}', 'MUTUAL_FUND' if i % 2 == 0 else 'ETF',
+                                   round(rng.uniform(1, MAX_PRICE), 2), f'0PMOCK{i:04X}', rng.randint(1, 5),
+                                   rng.random() < bad_rate, rng.random() < bad_rate))
+        self.by_symbol = {fund.symbol: fund for fund in self.funds}
+        self.index = {fund.symbol: i for i, fund in enumerate(self.funds)}
+        self.by_performance_id = {fund.performance_id: fund for fund in self.funds}
+        self.by_quote_type = {quote_type: [] for quote_type in SCREEN_QUOTE_TYPES}
+        for fund in sorted(self.funds, key=lambda fund: fund.price):
+            self.by_quote_type.setdefault(fund.quote_type, []).append(fund)
+        # Auto-complete also lists the next `siblings` funds, like the share classes of a real fund family.
+        self.siblings = siblings
+        self.screen_data = load_fixture('screen_data.json')
+        self.quote = self.screen_data['finance']['result'][0]['quotes'][0]
+        self.yh_data = load_fixture('yh_get_summary.json')
+        self.yh_bad_data = load_fixture('yh_bad_data.json')
+        self.perf_id_result = load_fixture('perf_id_data.json')['results'][0]
+        self.ms_data = load_fixture('ms_get_detail.json')[0]
+
+    def screen(self, quote_type: str, offset: int, size: int, payload: list) -> dict:
+        operator, operands = payload[0]['operands'][0]['operator'], payload[0]['operands'][0]['operands']
+        floor = operands[1]
+        roof = operands[2] if operator == 'btwn' else None
+        funds = [fund for fund in self.by_quote_type[quote_type]
+                 if fund.price > floor and (roof is None or fund.price <= roof)]
+        quotes = []
+        for fund in funds[offset:offset + size]:
+            quote = copy.deepcopy(self.quote)
+            quote['symbol'] = fund.symbol
+            quote['quoteType'] = SCREEN_QUOTE_TYPES[fund.quote_type]
+            quote['longName'] = f'Mock Fund {fund.symbol}'
+            quote['regularMarketPrice'] = {'raw': fund.price, 'fmt': f'{fund.price:.2f}'}
+            quotes.append(quote)
+        data = copy.deepcopy(self.screen_data)
+        data['finance']['result'][0].update({'start': offset, 'count': len(quotes), 'total': len(funds),
+                                             'quotes': quotes})
+        return data
+
+    def summary(self, symbol: str, err: bool) -> dict:
+        fund = self.by_symbol.get(symbol)
+        if fund is None or fund.yh_bad or err:
+            data = copy.deepcopy(self.yh_bad_data)
+        else:
+            data = copy.deepcopy(self.yh_data)
+            data['quoteType']['quoteType'] = SCREEN_QUOTE_TYPES[fund.quote_type]
+        data['symbol'] = symbol
+        data['quoteType']['symbol'] = symbol
+        return data
+
+    def auto_complete(self, query: str) -> dict:
+        index = self.index.get(query)
+        if index is None:
+            return {'count': 0, 'pages': 0, 'results': []}
+        results = []
+        for listed in self.funds[index:index + 1 + self.siblings]:
+            result = copy.deepcopy(self.perf_id_result)
+            result.update({'id': f'us_security-{listed.performance_id}', 'performanceId': listed.performance_id,
+                           'ticker': listed.symbol, 'name': f'Mock Fund {listed.symbol}'})
+            results.append(result)
+        return {'count': len(results), 'pages': 1, 'results': results}
+
+    def detail(self, performance_id: str, err: bool) -> list:
+        fund = self.by_performance_id.get(performance_id)
+        if fund is None or fund.ms_bad or err:
+            return [{}]
+        data = copy.deepcopy(self.ms_data)
+        data.update({'symbol': fund.symbol, 'RegionAndTicker': f'USA:{fund.symbol}', 'PerformanceId': performance_id,
+                     'RequestKey': performance_id})
+        data['Detail']['StarRating'] = fund.star_rating
+        return [data]
+
+
+class Faults:
+    # Latency is log-normal around `latency` seconds. The rates are per request, apart from bad funds which the
+    # Universe fixes up front.
+    def __init__(self, latency: float = 0, latency_sigma: float = .5, rate_429: float = 0, rate_5xx: float = 0,
+                 rate_err: float = 0, seed: int = 0):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_err = rate_err
+        self.rng = random.Random(seed)
+
+    def delay(self) -> float:
+        if self.latency <= 0:
+            return 0
+        return self.rng.lognormvariate(0, self.latency_sigma) * self.latency
+
+    def status(self) -> int:
+        roll = self.rng.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return self.rng.choice([500, 502, 503])
+        return 200
+
+    def err(self) -> bool:
+        return self.rng.random() < self.rate_err
+
+
+class MockAPI:
+    def __init__(self, universe: Universe, faults: Faults):
+        self.universe = universe
+        self.faults = faults
+        # (endpoint, status) -> requests answered.
+        self.calls = Counter()
+        # (arrived, endpoint, symbol or performance id, status) per request to a per-fund endpoint, in answer order.
+        self.requests = []
+
+    async def answer(self, request: web.Request, endpoint: str, body, entry: str = None) -> web.Response:
+        arrived = time.monotonic()
+        await asyncio.sleep(self.faults.delay())
+        status = self.faults.status()
+        self.calls[endpoint, status] += 1
+        if entry is not None:
+            self.requests.append((arrived, endpoint, entry, status))
+        if status == 429:
+            return web.Response(status=429, headers={'Retry-After': str(RETRY_AFTER),
+                                                     'X-RateLimit-Requests-Remaining': '0'})
+        if status != 200:
+            return web.Response(status=status)
+        response = web.json_response(body() if callable(body) else body)
+        # Compressed when the client asks for it, as the RapidAPI hosts do.
+        response.enable_compression()
+        return response
+
+    async def screen(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        if request.query.get('quoteType') not in SCREEN_QUOTE_TYPES:
+            self.calls['screeners/list', 400] += 1
+            return web.Response(status=400, text=f'Unknown quoteType {request.query.get("quoteType")}.')
+        return await self.answer(request, 'screeners/list', lambda: self.universe.screen(
+            request.query['quoteType'], int(request.query.get('offset', 0)),
+            int(request.query.get('size', PAGE_SIZE)), payload))
+
+    async def summary(self, request: web.Request) -> web.Response:
+        err = self.faults.err()
+        return await self.answer(request, 'stock/v2/get-summary',
+                                 lambda: self.universe.summary(request.query['symbol'], err), request.query['symbol'])
+
+    async def auto_complete(self, request: web.Request) -> web.Response:
+        return await self.answer(request, 'market/v2/auto-complete',
+                                 lambda: self.universe.auto_complete(request.query['q']), request.query['q'])
+
+    async def detail(self, request: web.Request) -> web.Response:
+        err = self.faults.err()
+        return await self.answer(request, 'stock/get-detail',
+                                 lambda: self.universe.detail(request.query['PerformanceId'], err),
+                                 request.query['PerformanceId'])
+
+    def yh_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/screeners/list', self.screen)
+        app.router.add_get('/stock/v2/get-summary', self.summary)
+        return app
+
+    def ms_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/market/v2/auto-complete', self.auto_complete)
+        app.router.add_get('/stock/get-detail', self.detail)
+        return app
+
+    async def start(self, host: str = HOST, yh_port: int = YH_PORT, ms_port: int = MS_PORT) -> [web.AppRunner]:
+        # The APIs listen on separate ports so the pipeline still tells them apart by origin.
+        runners = []
+        for app, port in [(self.yh_app(), yh_port), (self.ms_app(), ms_port)]:
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            runners.append(runner)
+        return runners
+
+    def stats(self) -> str:
+        return ', '.join(f'{endpoint} {status}: {count}' for (endpoint, status), count in sorted(self.calls.items()))
+
+
+async def serve(api: MockAPI, host: str, yh_port: int, ms_port: int):
+    runners = await api.start(host, yh_port, ms_port)
+    print(f'"yh_base_url": "http://{host}:{yh_port}", "ms_base_url": "http://{host}:{ms_port}"')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(api.stats())
+        for runner in runners:
+            await runner.cleanup()
+
+
+def arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Local stand-in for the YH and MS RapidAPI endpoints. Put the '
+                                                 'printed base urls in data/settings.json to run main.py against it.')
+    parser.add_argument('--funds', type=int, default=FUNDS)
+    parser.add_argument('--siblings', type=int, default=0, help='other funds listed by each auto-complete')
+    parser.add_argument('--bad-rate', type=float, default=0, help='share of funds the APIs always reject')
+    parser.add_argument('--latency', type=float, default=0, help='median seconds per response')
+    parser.add_argument('--latency-sigma', type=float, default=.5)
+    parser.add_argument('--rate-429', type=float, default=0)
+    parser.add_argument('--rate-5xx', type=float, default=0)
+    parser.add_argument('--rate-err', type=float, default=0, help="share of responses that are 'err' payloads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--yh-port', type=int, default=YH_PORT)
+    parser.add_argument('--ms-port', type=int, default=MS_PORT)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = arguments()
+    mock_api = MockAPI(Universe(args.funds, args.bad_rate, args.siblings, args.seed),
+                       Faults(args.latency, args.latency_sigma, args.rate_429, args.rate_5xx, args.rate_err,
+                              args.seed))
+    try:
+        asyncio.run(serve(mock_api, args.host, args.yh_port, args.ms_port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,68 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS_DIR = os.path.join(REPO_DIR, 'tests', 'defaults')
+
+RESPONSES = 2000
+CONCURRENCY = 20
+PROCESSES = 2
+HEARTBEAT = .001
+
+
+async def heartbeat(lags: list):
+    # The longest the loop takes to come back to a 1ms sleep is how long a parse keeps the I/O workers waiting.
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT)
+        lags.append(time.perf_counter() - start - HEARTBEAT)
+
+
+async def parse_all(http_requests, parse, payload: bytes, responses: int) -> (float, float, float):
+    lags = []
+    beat = asyncio.create_task(heartbeat(lags))
+    remaining = iter(range(responses))
+
+    async def worker():
+        for _ in remaining:
+            # Stands in for awaiting the response body, the point where a real worker hands the loop back.
+            await asyncio.sleep(0)
+            await http_requests.parse_payload(parse, payload)
+
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    await asyncio.gather(*[worker() for _ in range(CONCURRENCY)])
+    wall, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+    beat.cancel()
+    return wall, cpu, max(lags, default=0)
+
+
+def main(responses: int, processes: int):
+    # Importing the repo creates ./data and ./logs, so keep them out of the checkout.
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, REPO_DIR)
+    import http_requests
+    from parsers import parse_yh
+
+    with open(os.path.join(DEFAULTS_DIR, 'yh_good_data.json'), 'rb') as fixture:
+        payload = fixture.read()
+
+    print(f'{"parse stage":<16}{"responses/s":>14}{"loop CPU s":>12}{"max loop lag ms":>18}')
+    wall, cpu, lag = asyncio.run(parse_all(http_requests, parse_yh, payload, responses))
+    print(f'{"inline":<16}{responses / wall:>14.0f}{cpu:>12.3f}{lag * 1000:>18.2f}')
+
+    http_requests.parse_pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('forkserver'))
+    try:
+        asyncio.run(parse_all(http_requests, parse_yh, payload, processes))
+        wall, cpu, lag = asyncio.run(parse_all(http_requests, parse_yh, payload, responses))
+        print(f'{f"{processes} processes":<16}{responses / wall:>14.0f}{cpu:>12.3f}{lag * 1000:>18.2f}')
+    finally:
+        http_requests.parse_pool.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else RESPONSES, int(sys.argv[2]) if len(sys.argv) > 2 else PROCESSES)
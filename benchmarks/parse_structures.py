@@ -0,0 +1,55 @@
+import copy
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS_DIR = os.path.join(REPO_DIR, 'tests', 'defaults')
+
+ROUNDS = 200
+
+# Fixture, response class and how the class is handed the fixture.
+FIXTURES = [
+    ('screen_data.json', 'ScreenerResponse', lambda data: data),
+    ('yh_get_summary.json', 'YHFinanceResponse', lambda data: data),
+    ('yh_good_data.json', 'YHFinanceResponse', lambda data: data),
+    ('ms_get_detail.json', 'MSFinanceResponse', lambda data: data[0]),
+    ('perf_id_data.json', 'PerformanceIdResponse', lambda data: data['results'][0]),
+    ('perf_id_data.json', 'PerformanceIdResults', lambda data: data)
+]
+
+
+def load_structures(path: str):
+    # Any structures.py can be measured, e.g. the previous one from `git show HEAD~1:structures.py`.
+    spec = importlib.util.spec_from_file_location('measured_structures', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(response_class, data, rounds: int) -> (float, float, int):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        response_class(data).to_dict()
+    parse_rate = rounds / (time.perf_counter() - start)
+
+    tracemalloc.start()
+    responses = [response_class(data) for _ in range(rounds)]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del responses
+    return parse_rate, retained / rounds, peak
+
+
+if __name__ == '__main__':
+    structures = load_structures(sys.argv[1] if len(sys.argv) > 1 else os.path.join(REPO_DIR, 'structures.py'))
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else ROUNDS
+    print(f'{"fixture":<22}{"parse + to_dict/s":>20}{"bytes/response":>18}{"peak bytes":>14}')
+    for file_name, class_name, select in FIXTURES:
+        with open(os.path.join(DEFAULTS_DIR, file_name)) as fixture:
+            data = select(json.load(fixture))
+        rate, retained, peak = measure(getattr(structures, class_name), copy.deepcopy(data), rounds)
+        print(f'{file_name:<22}{rate:>20.0f}{retained:>18.0f}{peak:>14}')
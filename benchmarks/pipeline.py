@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_api import MockAPI, Universe, Faults, HOST, YH_PORT, MS_PORT
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = [1000, 10000, 50000]
+# Relative drop in funds/s, or rise in API calls per row, that --compare reports as a regression.
+REGRESSION_THRESHOLD = .1
+
+# Enough of settings.json for main() to run against the mock at full speed. --settings overrides any of it.
+BENCHMARK_SETTINGS = {
+    'api_key': 'benchmark',
+    'log_type': 'INFO',
+    'max_yh_calls': 10 ** 9,
+    'max_ms_calls': 10 ** 9,
+    'yh_workers': 10,
+    'ms_workers': 10,
+    'yh_rate': 500,
+    'yh_burst': 50,
+    'yh_max_rate': 1000,
+    'ms_rate': 500,
+    'ms_burst': 50,
+    'ms_max_rate': 1000,
+    'last_month_ran': datetime.date.today().month
+}
+
+VALID_FUNDS_SQL = 'SELECT symbol FROM funds'
+OUTPUT_FUNDS_SQL = '''
+SELECT symbol, longName, quoteType, regularMarketPrice, tenYear, starRating FROM funds
+WHERE symbol IN ({valid_funds_sql}) AND msFinanceLastAcquired IS NOT NULL;
+'''
+
+
+def prepare(workdir: str, settings: dict):
+    # utils creates whatever of data/ is missing, so only the files the benchmark depends on are written.
+    os.makedirs(os.path.join(workdir, 'data'))
+    with open(os.path.join(workdir, 'data', 'settings.json'), 'w') as settings_file:
+        json.dump(settings, settings_file, indent=4)
+    with open(os.path.join(workdir, 'data', 'valid_funds.sql'), 'w') as valid_funds_file:
+        valid_funds_file.write(VALID_FUNDS_SQL)
+    with open(os.path.join(workdir, 'data', 'output_funds.sql'), 'w') as output_funds_file:
+        output_funds_file.write(OUTPUT_FUNDS_SQL)
+
+
+def stage_rates(dbname: str, start_ms: int) -> dict:
+    # Each stage's rate is the funds it finished over the time from the start of the run to its last write. The funds
+    # timestamps are database.unix_time() microseconds, performanceIds.acquired is epoch_ms() milliseconds.
+    connection = sqlite3.connect(dbname)
+    try:
+        stages = {}
+        for stage, sql, per_second in [
+            ('screen', 'SELECT COUNT(*), MAX(lastScreened) FROM funds WHERE lastScreened >= :start', 10 ** 6),
+            ('yh', 'SELECT COUNT(*), MAX(yhFinanceLastAcquired) FROM funds WHERE yhFinanceLastAcquired >= :start',
+             10 ** 6),
+            ('perf', 'SELECT COUNT(*), MAX(acquired) FROM performanceIds WHERE acquired >= :start', 1000),
+            ('ms', 'SELECT COUNT(*), MAX(msFinanceLastAcquired) FROM funds WHERE msFinanceLastAcquired >= :start',
+             10 ** 6)
+        ]:
+            start = start_ms * per_second // 1000
+            funds, last = connection.execute(sql, {'start': start}).fetchone()
+            seconds = (last - start) / per_second if funds else 0
+            stages[stage] = {'funds': funds, 'seconds': seconds, 'funds_per_sec': funds / seconds if seconds else 0}
+        return stages
+    finally:
+        connection.close()
+
+
+def run_child(workdir: str, result_file: str):
+    # Runs in its own process so peak RSS is the pipeline's alone and utils reads this run's settings on import.
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import main
+    import utils
+
+    start_ms = int(time.time() * 1000)
+    start = time.perf_counter()
+    success = main.main()
+    wall = time.perf_counter() - start
+    with open('tickers.csv', newline='') as output_csv:
+        rows = max(sum(1 for _ in csv.reader(output_csv)) - 1, 0)
+    result = {
+        'success': success,
+        'wall_seconds': wall,
+        'rows': rows,
+        'stages': stage_rates('tickerTracker.db', start_ms),
+        'counted_calls': {'yh': utils.progress['yh_api_calls'], 'ms': utils.progress['ms_api_calls']},
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'db_bytes': sum(os.path.getsize(name) for name in os.listdir('.') if name.startswith('tickerTracker.db'))
+    }
+    with open(result_file, 'w') as result_output:
+        json.dump(result, result_output)
+
+
+async def run_size(funds: int, args: argparse.Namespace, api: MockAPI = None) -> dict:
+    # The caller can pass its own api to look at the requests afterwards.
+    if api is None:
+        api = MockAPI(Universe(funds, args.bad_rate, args.siblings, args.seed),
+                      Faults(args.latency, args.latency_sigma, args.rate_429, args.rate_5xx, args.rate_err, args.seed))
+    runners = await api.start(HOST, args.yh_port, args.ms_port)
+    workdir = tempfile.mkdtemp(prefix=f'pipeline_{funds}_')
+    result_file = os.path.join(workdir, 'result.json')
+    prepare(workdir, BENCHMARK_SETTINGS | {'yh_base_url': f'http://{HOST}:{args.yh_port}',
+                                           'ms_base_url': f'http://{HOST}:{args.ms_port}'} | args.settings)
+    try:
+        child = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--child', workdir,
+                                                     result_file)
+        await child.wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+    if child.returncode != 0:
+        raise RuntimeError(f'The {funds} fund run failed. Logs are in {workdir}.')
+    with open(result_file) as result_input:
+        result = json.load(result_input)
+    api_calls = sum(api.calls.values())
+    result.update({
+        'funds': funds,
+        # Funds the run screened, not the universe size, so a run that loses funds does not look as fast.
+        'funds_per_sec': result['stages']['screen']['funds'] / result['wall_seconds'],
+        'api_calls': api_calls,
+        'api_calls_by_endpoint': {f'{endpoint} {status}': count for (endpoint, status), count in api.calls.items()},
+        'api_calls_per_row': api_calls / result['rows'] if result['rows'] else None
+    })
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def report(results: [dict]):
+    print(f'{"funds":>8}{"wall s":>10}{"funds/s":>10}{"screen/s":>10}{"yh/s":>10}{"perf/s":>10}{"ms/s":>10}'
+          f'{"rows":>8}{"calls/row":>11}{"RSS MB":>9}{"DB MB":>8}')
+    for result in results:
+        stages = result['stages']
+        calls_per_row = result['api_calls_per_row']
+        print(f'{result["funds"]:>8}{result["wall_seconds"]:>10.1f}{result["funds_per_sec"]:>10.0f}'
+              f'{stages["screen"]["funds_per_sec"]:>10.0f}{stages["yh"]["funds_per_sec"]:>10.0f}'
+              f'{stages["perf"]["funds_per_sec"]:>10.0f}{stages["ms"]["funds_per_sec"]:>10.0f}{result["rows"]:>8}'
+              f'{calls_per_row if calls_per_row is not None else float("nan"):>11.2f}'
+              f'{result["peak_rss_bytes"] / 2 ** 20:>9.0f}{result["db_bytes"] / 2 ** 20:>8.1f}')
+
+
+def compare(results: [dict], baseline_file: str) -> bool:
+    # Returns whether any size regressed against the same size in the baseline.
+    with open(baseline_file) as baseline_input:
+        baseline = {result['funds']: result for result in json.load(baseline_input)['results']}
+    regressed = False
+    for result in results:
+        before = baseline.get(result['funds'])
+        if before is None:
+            continue
+        speed = result['funds_per_sec'] / before['funds_per_sec'] - 1
+        calls = (result['api_calls_per_row'] or 0) / (before['api_calls_per_row'] or 1) - 1
+        slower, costlier = speed < -REGRESSION_THRESHOLD, calls > REGRESSION_THRESHOLD
+        regressed = regressed or slower or costlier
+        print(f'{result["funds"]:>8} funds: funds/s {speed:+.1%}{" REGRESSION" if slower else ""}, '
+              f'calls/row {calls:+.1%}{" REGRESSION" if costlier else ""}')
+    return regressed
+
+
+def arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runs main() end to end against benchmarks/mock_api.py.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--output', default='pipeline_results.json', help='where the results are written as json')
+    parser.add_argument('--compare', help='an earlier --output to check for regressions')
+    parser.add_argument('--settings', type=json.loads, default={}, help='json merged over the benchmark settings')
+    parser.add_argument('--siblings', type=int, default=0)
+    parser.add_argument('--bad-rate', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--latency-sigma', type=float, default=.5)
+    parser.add_argument('--rate-429', type=float, default=0)
+    parser.add_argument('--rate-5xx', type=float, default=0)
+    parser.add_argument('--rate-err', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--yh-port', type=int, default=YH_PORT)
+    parser.add_argument('--ms-port', type=int, default=MS_PORT)
+    return parser.parse_args()
+
+
+def benchmark(args: argparse.Namespace) -> int:
+    results = [asyncio.run(run_size(funds, args)) for funds in args.sizes]
+    report(results)
+    options = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    with open(args.output, 'w') as output:
+        json.dump({'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'options': options, 'results': results}, output, indent=4)
+    if args.compare and compare(results, args.compare):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3])
+    else:
+        sys.exit(benchmark(arguments()))
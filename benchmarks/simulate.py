@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import bisect
+import functools
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from queue import Queue
+
+from mock_api import Universe, SCREEN_QUOTE_TYPES
+from pipeline import prepare
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FUNDS = 100000
+# A quick run that proves the replay finishes, e.g. after touching the loop or the rate limiter.
+SMOKE_FUNDS = 500
+# Median seconds per response and the upstream's own limit in requests per second for each API.
+LATENCY = .3
+LATENCY_SIGMA = .5
+QUOTA_RATE = 5
+
+# The repo's defaults, apart from what a simulation cannot use: every call counts and nothing is cached or pooled.
+SIMULATION_SETTINGS = {
+    'api_key': 'simulation',
+    'log_type': 'INFO',
+    'max_yh_calls': 10 ** 9,
+    'max_ms_calls': 10 ** 9,
+    'db_batch_latency': 0,
+    'parse_processes': 0,
+    'http_cache_bytes': 0
+}
+
+STAGE_APIS = {'screen_fund': 'yh', 'fetch_yh_fund': 'yh', 'fetch_perf_id': 'ms', 'fetch_ms_fund': 'ms'}
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    # Time only moves when the loop has nothing left to run. It then waits for the db thread to finish what it was
+    # handed, since that can push new work, and jumps to the next timer instead of sleeping until it. Every sleep,
+    # timeout, rate limit and backoff in the pipeline reads loop.time(), so they all run on this clock. Relies on the
+    # _ready and _scheduled queues of asyncio's BaseEventLoop. Each jump is at least the clock resolution: a rate
+    # limiter a rounding error short of a token sleeps for ~1e-17s, and if that did not move the clock it would
+    # refill nothing and sleep again forever.
+    def __init__(self, background: Queue, background_thread: str):
+        super().__init__()
+        self.background = background
+        self.background_thread = background_thread
+        self.virtual_time = 0.0
+
+    def time(self) -> float:
+        return self.virtual_time
+
+    def settle(self):
+        with self.background.all_tasks_done:
+            while self.background.unfinished_tasks and self.background_alive():
+                self.background.all_tasks_done.wait(.1)
+
+    def background_alive(self) -> bool:
+        return any(thread.name == self.background_thread for thread in threading.enumerate())
+
+    def _run_once(self):
+        if not self._ready:
+            self.settle()
+        if not self._ready and self._scheduled:
+            self.virtual_time = max(self.virtual_time + self._clock_resolution, self._scheduled[0]._when)
+        super()._run_once()
+
+
+class Upstream:
+    # Stands in for both APIs in process. Responses are built as parsed records straight from the Universe, so a
+    # replay pays for neither the network nor JSON. Each API sheds requests beyond its quota rate with a 429.
+    def __init__(self, universe: Universe, latency: float, latency_sigma: float, quota_rate: float, rate_5xx: float,
+                 rate_err: float, seed: int):
+        self.universe = universe
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.quota_rate = quota_rate
+        self.rate_5xx = rate_5xx
+        self.rate_err = rate_err
+        self.rng = random.Random(seed)
+        self.quota = {}
+        self.prices = {quote_type: [fund.price for fund in funds]
+                       for quote_type, funds in universe.by_quote_type.items()}
+        # (api, endpoint, status) -> requests answered.
+        self.calls = Counter()
+
+    def admit(self, api: str, now: float) -> bool:
+        if self.quota_rate <= 0:
+            return True
+        tokens, updated = self.quota.get(api, (self.quota_rate, now))
+        tokens = min(self.quota_rate, tokens + (now - updated) * self.quota_rate)
+        admitted = tokens >= 1
+        self.quota[api] = (tokens - 1 if admitted else tokens, now)
+        return admitted
+
+    async def respond(self, api: str, endpoint: str, origin: str, build):
+        loop = asyncio.get_running_loop()
+        sent = loop.time()
+        if not self.admit(api, sent):
+            status = 429
+        elif self.rng.random() < self.rate_5xx:
+            status = 503
+        else:
+            status = 200
+        if self.latency > 0:
+            await asyncio.sleep(self.rng.lognormvariate(0, self.latency_sigma) * self.latency)
+        self.calls[api, endpoint, status] += 1
+        rate_limiter = self.http_requests.rate_limits.get(origin)
+        if rate_limiter is not None:
+            rate_limiter.observe(status, {'Retry-After': '1'} if status == 429 else {}, sent)
+        if status != 200:
+            return None
+        return build()
+
+    def bind(self, main, http_requests, parsers, structures):
+        # Replaces the request functions main imported, so everything above them runs unchanged.
+        self.http_requests = http_requests
+        yh_template = self.universe.yh_data
+
+        def screen(quote_type: str, offset: int, payload: list):
+            operator, operands = payload[0]['operands'][0]['operator'], payload[0]['operands'][0]['operands']
+            prices = self.prices.get(quote_type, [])
+            low = bisect.bisect_right(prices, operands[1])
+            high = bisect.bisect_right(prices, operands[2]) if operator == 'btwn' else len(prices)
+            funds = self.universe.by_quote_type.get(quote_type, [])[low:high]
+            quotes = [{'symbol': fund.symbol, 'quoteType': SCREEN_QUOTE_TYPES[fund.quote_type],
+                       'regularMarketPrice': fund.price}
+                      for fund in funds[offset:offset + 50]]
+            return structures.ScreenerResponse({'finance': {'result': [
+                {'start': offset, 'count': len(quotes), 'total': len(funds), 'quotes': quotes}]}})
+
+        def summary(symbol: str):
+            fund = self.universe.by_symbol.get(symbol)
+            if fund is None or fund.yh_bad or self.rng.random() < self.rate_err:
+                return parsers.BadPayload('get-summary err')
+            return structures.YHFinanceResponse(yh_template | {'symbol': symbol})
+
+        def auto_complete(symbol: str):
+            index = self.universe.index.get(symbol)
+            listed = [] if index is None else self.universe.funds[index:index + 1 + self.universe.siblings]
+            return structures.PerformanceIdResults(
+                {'results': [{'ticker': fund.symbol, 'performanceId': fund.performance_id} for fund in listed]})
+
+        def detail(performance_id: str):
+            fund = self.universe.by_performance_id.get(performance_id)
+            if fund is None or fund.ms_bad or self.rng.random() < self.rate_err:
+                return parsers.BadPayload('no get-detail')
+            return structures.MSFinanceResponse(
+                {'Detail': {'StarRating': fund.star_rating}, 'RegionAndTicker': f'USA:{fund.symbol}'})
+
+        async def get_screen(session, quote_type, offset, payload, parse=None):
+            if quote_type not in SCREEN_QUOTE_TYPES:
+                # Rejected before the quota, as the API's own validation would.
+                self.calls['yh', 'screeners/list', 400] += 1
+                return None
+            return await self.respond('yh', 'screeners/list', http_requests.YH_ORIGIN,
+                                      lambda: screen(quote_type, offset, payload))
+
+        async def get_yh_info(session, symbol, parse=None):
+            return await self.respond('yh', 'stock/v2/get-summary', http_requests.YH_ORIGIN,
+                                      lambda: summary(symbol))
+
+        async def get_perf_id(session, symbol, parse=None):
+            return await self.respond('ms', 'market/v2/auto-complete', http_requests.MS_ORIGIN,
+                                      lambda: auto_complete(symbol))
+
+        async def get_ms_info(session, performance_id, parse=None):
+            return await self.respond('ms', 'stock/get-detail', http_requests.MS_ORIGIN,
+                                      lambda: detail(performance_id))
+
+        main.get_screen, main.get_yh_info, main.get_perf_id, main.get_ms_info = \
+            get_screen, get_yh_info, get_perf_id, get_ms_info
+
+
+class Recorder:
+    # How long each item waited between being queued and its call starting, rate limiting and open circuits
+    # included, and how long the workers of each API spent in calls.
+    def __init__(self):
+        self.queued = {}
+        self.waits = defaultdict(list)
+        self.busy = Counter()
+
+    def bind(self, main):
+        enqueue = main.enqueue
+
+        def recorded_enqueue(queue, priority, item):
+            if item.method is not None:
+                self.queued[item.method, item.args] = asyncio.get_running_loop().time()
+            enqueue(queue, priority, item)
+
+        def recorded(fetch, api: str):
+            @functools.wraps(fetch)
+            async def wrapper(*args, **kwargs):
+                start = asyncio.get_running_loop().time()
+                queued = self.queued.pop((wrapper, args), None)
+                if queued is not None:
+                    self.waits[api].append(start - queued)
+                try:
+                    return await fetch(*args, **kwargs)
+                finally:
+                    self.busy[api] += asyncio.get_running_loop().time() - start
+            return wrapper
+
+        main.enqueue = recorded_enqueue
+        for name, api in STAGE_APIS.items():
+            setattr(main, name, recorded(getattr(main, name), api))
+
+
+def percentile(values: [float], fraction: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def apply_overrides(overrides: dict):
+    # A key like "retry_policy.RETRY_BASE_DELAY" or "main.YH_PRIORITY" sets that module constant for this run. A
+    # constant imported by name, like main.MAX_ATTEMPTS, has to be set in the module that uses it.
+    for key, value in overrides.items():
+        module, name = key.rsplit('.', 1)
+        setattr(sys.modules[module], name, value)
+
+
+def run_child(workdir: str, result_file: str, options: dict):
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import http_requests
+    import main
+    import parsers
+    import structures
+    import utils
+
+    random.seed(options['seed'])
+    apply_overrides(options['overrides'])
+    universe = Universe(options['funds'], options['bad_rate'], options['siblings'], options['seed'])
+    upstream = Upstream(universe, options['latency'], options['latency_sigma'], options['quota_rate'],
+                        options['rate_5xx'], options['rate_err'], options['seed'])
+    upstream.bind(main, http_requests, parsers, structures)
+    recorder = Recorder()
+    recorder.bind(main)
+    # Built from the stage priorities on import, so it is rebuilt in case a policy changed them.
+    main.STAGE_PRIORITIES = {'yh': main.YH_PRIORITY, 'perf': main.PERF_ID_PRIORITY, 'ms': main.MS_PRIORITY}
+
+    loop = VirtualClockLoop(main.db_write_queue, 'db_master')
+    asyncio.set_event_loop(loop)
+    start = time.perf_counter()
+    try:
+        success = loop.run_until_complete(main.run_pipeline())
+        virtual_seconds = loop.time()
+    finally:
+        loop.close()
+    real_seconds = time.perf_counter() - start
+
+    connection = sqlite3.connect('tickerTracker.db')
+    try:
+        complete = connection.execute(
+            'SELECT COUNT(*) FROM funds WHERE msFinanceLastAcquired IS NOT NULL;').fetchone()[0]
+    finally:
+        connection.close()
+    apis = {}
+    for api in ('yh', 'ms'):
+        workers = utils.settings[f'{api}_workers']
+        waits = recorder.waits[api]
+        statuses = Counter()
+        for (called_api, _, status), count in upstream.calls.items():
+            if called_api == api:
+                statuses[status] += count
+        apis[api] = {
+            'workers': workers,
+            'calls': sum(statuses.values()),
+            'calls_by_status': {str(status): count for status, count in sorted(statuses.items())},
+            'counted_calls': utils.progress[f'{api}_api_calls'],
+            'mean_wait': sum(waits) / len(waits) if waits else 0,
+            'p95_wait': percentile(waits, .95),
+            'max_wait': max(waits, default=0),
+            'idle': 1 - recorder.busy[api] / (workers * virtual_seconds) if workers and virtual_seconds else 0
+        }
+    result = {'success': success, 'virtual_seconds': virtual_seconds, 'real_seconds': real_seconds,
+              'complete_funds': complete, 'apis': apis}
+    with open(result_file, 'w') as result_output:
+        json.dump(result, result_output)
+
+
+def simulate(name: str, policy: dict, args: argparse.Namespace) -> dict:
+    # Settings keys go to settings.json, dotted keys are module constants.
+    settings = {key: value for key, value in policy.items() if '.' not in key}
+    overrides = {key: value for key, value in policy.items() if '.' in key}
+    workdir = tempfile.mkdtemp(prefix=f'simulate_{name}_')
+    result_file = os.path.join(workdir, 'result.json')
+    prepare(workdir, SIMULATION_SETTINGS | settings)
+    options = {'funds': args.funds, 'bad_rate': args.bad_rate, 'siblings': args.siblings, 'seed': args.seed,
+               'latency': args.latency, 'latency_sigma': args.latency_sigma, 'quota_rate': args.quota_rate,
+               'rate_5xx': args.rate_5xx, 'rate_err': args.rate_err, 'overrides': overrides}
+    child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', workdir, result_file,
+                            json.dumps(options)])
+    if child.returncode != 0:
+        raise RuntimeError(f'Policy {name} failed. Logs are in {workdir}.')
+    with open(result_file) as result_input:
+        return {'policy': name, 'settings': policy} | json.load(result_input)
+
+
+def report(results: [dict]):
+    print(f'{"policy":<16}{"virtual h":>10}{"real s":>8}{"funds":>8}'
+          + ''.join(f'{f"{api} calls":>10}{f"{api} 429":>8}{f"{api} p95 wait":>13}{f"{api} idle":>9}'
+                    for api in ('yh', 'ms')))
+    for result in results:
+        line = f'{result["policy"]:<16}{result["virtual_seconds"] / 3600:>10.1f}{result["real_seconds"]:>8.1f}' \
+               f'{result["complete_funds"]:>8}'
+        for api in ('yh', 'ms'):
+            stats = result['apis'][api]
+            line += f'{stats["calls"]:>10}{stats["calls_by_status"].get("429", 0):>8}' \
+                    f'{stats["p95_wait"]:>12.1f}s{stats["idle"]:>9.0%}'
+        print(line)
+
+
+def policy(value: str) -> (str, dict):
+    name, _, settings = value.partition('=')
+    return name, json.loads(settings or '{}')
+
+
+def arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Replays a run of the pipeline on a virtual clock against a '
+                                                 'modelled upstream, once per policy.')
+    parser.add_argument('--policy', type=policy, action='append', dest='policies',
+                        help='name=json of settings and module constants, e.g. '
+                             'fast=\'{"yh_workers": 10, "main.MAX_ATTEMPTS": 4}\'. Repeatable.')
+    parser.add_argument('--funds', type=int, default=FUNDS)
+    parser.add_argument('--smoke', action='store_const', const=SMOKE_FUNDS, dest='funds',
+                        help=f'replay {SMOKE_FUNDS} funds, enough to show the replay finishes')
+    parser.add_argument('--siblings', type=int, default=0)
+    parser.add_argument('--bad-rate', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=LATENCY)
+    parser.add_argument('--latency-sigma', type=float, default=LATENCY_SIGMA)
+    parser.add_argument('--quota-rate', type=float, default=QUOTA_RATE, help='requests/s each API accepts, 0 for any')
+    parser.add_argument('--rate-5xx', type=float, default=0)
+    parser.add_argument('--rate-err', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='where the results are written as json')
+    return parser.parse_args()
+
+
+def run(args: argparse.Namespace):
+    results = [simulate(name, settings, args) for name, settings in args.policies or [('default', {})]]
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3], json.loads(sys.argv[4]))
+    else:
+        run(arguments())
@@ -1,10 +1,12 @@
 import datetime
+import json
 import re
 from dateutil.relativedelta import *
 import sqlite3
 import time
 
 import utils
+from filters import stage_filters, STAGE_SCREEN, STAGE_YH
 
 # region SQL Strings
 CREATE_FUNDS_TABLE = '''
@@ -54,6 +56,16 @@ CREATE TABLE IF NOT EXISTS funds (
 
 DROP_FUNDS_TABLE = '''DROP TABLE IF EXISTS funds;'''
 
+# performanceId IS NULL is already served by the UNIQUE (performanceId) index.
+CREATE_FUNDS_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS fundsYhFinanceLastAcquired ON funds (yhFinanceLastAcquired);',
+    '''CREATE INDEX IF NOT EXISTS fundsMsFinanceLastAcquired ON funds (msFinanceLastAcquired)
+    WHERE performanceId IS NOT NULL;''',
+    'CREATE INDEX IF NOT EXISTS fundsLastScreened ON funds (lastScreened);',
+    '''CREATE INDEX IF NOT EXISTS fundsQuoteTypePrice ON funds (quoteType, regularMarketPrice)
+    WHERE regularMarketPrice IS NOT NULL;'''
+]
+
 CREATE_ANNUALTOTALRETURNS_TABLE = '''
 CREATE TABLE IF NOT EXISTS annualTotalReturns (
     symbol TEXT NOT NULL,
@@ -77,6 +89,60 @@ CREATE TABLE IF NOT EXISTS brokerages (
 
 DROP_BROKERAGES_TABLE = '''DROP TABLE IF EXISTS brokerages;'''
 
+CREATE_JOBS_TABLE = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    stage TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    priority REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    nextRunAt INTEGER NOT NULL,
+    leaseExpires INTEGER,
+    created INTEGER NOT NULL,
+    PRIMARY KEY (stage, entry)
+);
+'''
+
+DROP_JOBS_TABLE = '''DROP TABLE IF EXISTS jobs;'''
+
+LEASE_DURATION_MS: int = 60 * 60 * 1000
+
+# symbol -> performanceId outlives the funds row, so a fund that is deleted and screened again does not need another
+# auto-complete call. A mapping is trusted for PERFORMANCE_ID_TTL_MONTHS after it was last verified, i.e. looked up or
+# confirmed by a get-detail response, and dropped when get-detail rejects its performanceId.
+CREATE_PERFORMANCE_IDS_TABLE = '''
+CREATE TABLE IF NOT EXISTS performanceIds (
+    symbol TEXT NOT NULL,
+    performanceId TEXT NOT NULL,
+    acquired INTEGER NOT NULL,
+    verified INTEGER NOT NULL,
+    PRIMARY KEY (symbol)
+);
+'''
+
+CREATE_PERFORMANCE_IDS_INDEX = '''
+CREATE INDEX IF NOT EXISTS performanceIdsPerformanceId ON performanceIds (performanceId);
+'''
+
+DROP_PERFORMANCE_IDS_TABLE = '''DROP TABLE IF EXISTS performanceIds;'''
+
+PERFORMANCE_ID_TTL_MONTHS: int = 12
+
+# Funds an API rejected, so the next screen does not bring them back and pay for the same failing calls. They are
+# tried again once BAD_FUND_TTL_MONTHS have passed since they were marked.
+CREATE_BAD_FUNDS_TABLE = '''
+CREATE TABLE IF NOT EXISTS badFunds (
+    symbol TEXT NOT NULL,
+    performanceId TEXT,
+    reason TEXT,
+    marked INTEGER NOT NULL,
+    PRIMARY KEY (symbol)
+);
+'''
+
+DROP_BAD_FUNDS_TABLE = '''DROP TABLE IF EXISTS badFunds;'''
+
+BAD_FUND_TTL_MONTHS: int = 3
+
 
 # endregion
 
@@ -84,147 +150,228 @@ class DB:
     def __init__(self, dbname='tickerTracker.db'):
         self.connection = sqlite3.connect(dbname)
         self.connection.create_function('REGEXP', 2, function_regex)
+        self.connection.execute('PRAGMA journal_mode = WAL;')
+        self.connection.execute('PRAGMA synchronous = NORMAL;')
         self.cursor = self.connection.cursor()
+        # Views read through their own connection so, under WAL, they see committed data without waiting on writes.
+        self.read_connection = sqlite3.connect(dbname)
+        self.read_connection.create_function('REGEXP', 2, function_regex)
+        self.read_cursor = self.read_connection.cursor()
+        self.batching = False
 
     def close_connections(self):
+        self.read_cursor.close()
+        self.read_connection.close()
         self.cursor.close()
         self.connection.close()
 
-    def create_tables(self):
+    def begin(self):
+        # Inside a batch every write runs in a savepoint so a failed item only rolls back its own changes.
+        self.cursor.execute('SAVEPOINT item;' if self.batching else 'BEGIN TRANSACTION;')
+
+    def commit(self):
+        self.cursor.execute('RELEASE item;' if self.batching else 'COMMIT TRANSACTION;')
+
+    def rollback(self):
+        if self.batching:
+            self.cursor.execute('ROLLBACK TO item;')
+            self.cursor.execute('RELEASE item;')
+        else:
+            self.cursor.execute('ROLLBACK TRANSACTION;')
+
+    def begin_batch(self):
         self.cursor.execute('BEGIN TRANSACTION;')
+        self.batching = True
+
+    def commit_batch(self):
+        self.batching = False
+        self.cursor.execute('COMMIT TRANSACTION;')
+
+    def create_tables(self):
+        self.begin()
         try:
             self.cursor.execute('PRAGMA foreign_keys = ON;')
             self.cursor.execute(CREATE_FUNDS_TABLE)
+            for create_index in CREATE_FUNDS_INDEXES:
+                self.cursor.execute(create_index)
             self.cursor.execute(CREATE_ANNUALTOTALRETURNS_TABLE)
             self.cursor.execute(CREATE_BROKERAGES_TABLE)
-            self.cursor.execute('COMMIT TRANSACTION;')
+            self.cursor.execute(CREATE_JOBS_TABLE)
+            self.cursor.execute(CREATE_PERFORMANCE_IDS_TABLE)
+            self.cursor.execute(CREATE_PERFORMANCE_IDS_INDEX)
+            self.cursor.execute(CREATE_BAD_FUNDS_TABLE)
+            now = epoch_ms()
+            self.cursor.execute('''
+            INSERT INTO performanceIds (symbol, performanceId, acquired, verified)
+            SELECT symbol, performanceId, :now, :now FROM funds WHERE performanceId IS NOT NULL
+            ON CONFLICT (symbol) DO NOTHING;
+            ''', {'now': now})
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
 
     def drop_tables(self):
-        self.cursor.execute('BEGIN TRANSACTION;')
+        self.begin()
         try:
             self.cursor.execute(DROP_ANNUALTOTALRETURNS_TABLE)
             self.cursor.execute(DROP_FUNDS_TABLE)
             self.cursor.execute(DROP_BROKERAGES_TABLE)
-            self.cursor.execute('COMMIT TRANSACTION;')
+            self.cursor.execute(DROP_JOBS_TABLE)
+            self.cursor.execute(DROP_PERFORMANCE_IDS_TABLE)
+            self.cursor.execute(DROP_BAD_FUNDS_TABLE)
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
 
     def add_from_screener(self, quotes):
-        self.cursor.execute('BEGIN TRANSACTION;')
+        now = unix_time()
+        for quote in quotes:
+            quote['unix_time'] = now
+        self.begin()
         try:
-            for quote in quotes:
-                quote['unix_time'] = unix_time()
-                rows = self.cursor.execute('SELECT symbol FROM funds WHERE symbol = :symbol;', quote)
-                if rows.fetchone():
-                    self.cursor.execute('''UPDATE funds
-                    SET
-                        longName = :longName,
-                        quoteType = :quoteType,
-                        firstTradeDateMilliseconds = :firstTradeDateMilliseconds,
-                        exchange = :exchange,
-                        market = :market,
-                        marketCap = :marketCap,
-                        marketState = :marketState,
-                        priceHint = :priceHint,
-                        priceToBook = :priceToBook,
-                        regularMarketChange = :regularMarketChange,
-                        regularMarketChangePercent = :regularMarketChangePercent,
-                        regularMarketPreviousClose = :regularMarketPreviousClose,
-                        regularMarketPrice = :regularMarketPrice,
-                        sharesOutstanding = :sharesOutstanding,
-                        tradeable = :tradeable,
-                        triggerable = :triggerable
-                    WHERE :symbol = symbol;''', quote)
-                else:
-                    self.cursor.execute('''INSERT INTO funds (
-                        symbol,
-                        longName,
-                        quoteType,
-                        firstTradeDateMilliseconds,
-                        exchange,
-                        market,
-                        marketCap,
-                        marketState,
-                        priceHint,
-                        priceToBook,
-                        regularMarketChange,
-                        regularMarketChangePercent,
-                        regularMarketPreviousClose,
-                        regularMarketPrice,
-                        sharesOutstanding,
-                        tradeable,
-                        triggerable
-                    ) VALUES (
-                        :symbol,
-                        :longName,
-                        :quoteType,
-                        :firstTradeDateMilliseconds,
-                        :exchange,
-                        :market,
-                        :marketCap,
-                        :marketState,
-                        :priceHint,
-                        :priceToBook,
-                        :regularMarketChange,
-                        :regularMarketChangePercent,
-                        :regularMarketPreviousClose,
-                        :regularMarketPrice,
-                        :sharesOutstanding,
-                        :tradeable,
-                        :triggerable
-                    );''', quote)
-                self.cursor.execute('UPDATE funds SET lastScreened = :unix_time WHERE :symbol = symbol;', quote)
-            self.cursor.execute('COMMIT TRANSACTION;')
+            bad = self.bad_symbols({quote['symbol'] for quote in quotes})
+            quotes = [quote for quote in quotes if quote['symbol'] not in bad]
+            self.cursor.executemany('''INSERT INTO funds (
+                symbol,
+                longName,
+                quoteType,
+                firstTradeDateMilliseconds,
+                exchange,
+                market,
+                marketCap,
+                marketState,
+                priceHint,
+                priceToBook,
+                regularMarketChange,
+                regularMarketChangePercent,
+                regularMarketPreviousClose,
+                regularMarketPrice,
+                sharesOutstanding,
+                tradeable,
+                triggerable,
+                lastScreened
+            ) VALUES (
+                :symbol,
+                :longName,
+                :quoteType,
+                :firstTradeDateMilliseconds,
+                :exchange,
+                :market,
+                :marketCap,
+                :marketState,
+                :priceHint,
+                :priceToBook,
+                :regularMarketChange,
+                :regularMarketChangePercent,
+                :regularMarketPreviousClose,
+                :regularMarketPrice,
+                :sharesOutstanding,
+                :tradeable,
+                :triggerable,
+                :unix_time
+            ) ON CONFLICT (symbol) DO UPDATE
+            SET
+                longName = excluded.longName,
+                quoteType = excluded.quoteType,
+                firstTradeDateMilliseconds = excluded.firstTradeDateMilliseconds,
+                exchange = excluded.exchange,
+                market = excluded.market,
+                marketCap = excluded.marketCap,
+                marketState = excluded.marketState,
+                priceHint = excluded.priceHint,
+                priceToBook = excluded.priceToBook,
+                regularMarketChange = excluded.regularMarketChange,
+                regularMarketChangePercent = excluded.regularMarketChangePercent,
+                regularMarketPreviousClose = excluded.regularMarketPreviousClose,
+                regularMarketPrice = excluded.regularMarketPrice,
+                sharesOutstanding = excluded.sharesOutstanding,
+                tradeable = excluded.tradeable,
+                triggerable = excluded.triggerable,
+                lastScreened = excluded.lastScreened;''', quotes)
+            self.restore_performance_ids({quote['symbol'] for quote in quotes})
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
 
-    def update_from_yh_finance(self, data):
-        self.cursor.execute('BEGIN TRANSACTION;')
-        data['unix_time'] = unix_time()
+    def update_from_yh_finance(self, funds: [dict]) -> set:
+        # Returns the symbols that are not in the database; the rest are written.
+        now = unix_time()
+        self.begin()
         try:
-            rows = self.cursor.execute('SELECT symbol FROM funds WHERE symbol = :symbol;', data)
-            if rows.fetchone():
-                self.cursor.execute('''UPDATE funds
-                SET
-                    ytd = :ytd,
-                    lastBearMkt = :lastBearMkt,
-                    lastBullMkt = :lastBullMkt,
-                    oneMonth = :oneMonth,
-                    threeMonth = :threeMonth,
-                    oneYear = :oneYear,
-                    threeYear = :threeYear,
-                    fiveYear = :fiveYear,
-                    tenYear = :tenYear,
-                    beta3Year = :beta3Year,
-                    category = :category,
-                    totalAssets = :totalAssets,
-                    fundFamily = :fundFamily,
-                    yield = :percent_yield,
-                    twelveBOne = :twelveBOne
-                WHERE :symbol = symbol;''', data)
-            else:
-                raise sqlite3.OperationalError(f'symbol {data["symbol"]} is not in the database.')
-            self.cursor.execute('DELETE FROM annualTotalReturns WHERE :symbol = symbol;', data)
-            for single_return in data['returns']:
-                single_return['symbol'] = data['symbol']
-                self.cursor.execute('INSERT OR IGNORE INTO annualTotalReturns VALUES (:symbol, :year, :annualValue);',
-                                    single_return)
-            for brokerage in data['brokerages']:
-                self.cursor.execute('INSERT OR IGNORE INTO brokerages VALUES (:symbol, :brokerage);',
-                                    {'symbol': data['symbol'], 'brokerage': brokerage})
-            self.cursor.execute('UPDATE funds SET yhFinanceLastAcquired = :unix_time WHERE :symbol = symbol;', data)
-            self.cursor.execute('COMMIT TRANSACTION;')
+            existing = self.existing_symbols({data['symbol'] for data in funds})
+            missing = {data['symbol'] for data in funds} - existing
+            funds = [data for data in funds if data['symbol'] in existing]
+            returns = []
+            brokerages = []
+            for data in funds:
+                data['unix_time'] = now
+                years = {}
+                for single_return in data['returns']:
+                    # The first value given for a year wins, as it did with INSERT OR IGNORE.
+                    years.setdefault(single_return['year'], single_return['annualValue'])
+                data['years'] = json.dumps(list(years))
+                data['brokerageNames'] = json.dumps(sorted(set(data['brokerages'])))
+                returns += [{'symbol': data['symbol'], 'year': year, 'annualValue': value}
+                            for year, value in years.items()]
+                brokerages += [{'symbol': data['symbol'], 'brokerage': brokerage}
+                               for brokerage in set(data['brokerages'])]
+            self.cursor.executemany('''UPDATE funds
+            SET
+                ytd = :ytd,
+                lastBearMkt = :lastBearMkt,
+                lastBullMkt = :lastBullMkt,
+                oneMonth = :oneMonth,
+                threeMonth = :threeMonth,
+                oneYear = :oneYear,
+                threeYear = :threeYear,
+                fiveYear = :fiveYear,
+                tenYear = :tenYear,
+                beta3Year = :beta3Year,
+                category = :category,
+                totalAssets = :totalAssets,
+                fundFamily = :fundFamily,
+                yield = :percent_yield,
+                twelveBOne = :twelveBOne,
+                yhFinanceLastAcquired = :unix_time
+            WHERE :symbol = symbol;''', funds)
+            # Returns and brokerages are diffed against what is stored so unchanged rows are not rewritten.
+            self.cursor.executemany('''
+            DELETE FROM annualTotalReturns WHERE symbol = :symbol AND year NOT IN (SELECT value FROM json_each(:years));
+            ''', funds)
+            self.cursor.executemany('''
+            INSERT INTO annualTotalReturns VALUES (:symbol, :year, :annualValue)
+            ON CONFLICT (symbol, year) DO UPDATE SET return = excluded.return WHERE return IS NOT excluded.return;
+            ''', returns)
+            self.cursor.executemany('''
+            DELETE FROM brokerages
+            WHERE symbol = :symbol AND brokerage NOT IN (SELECT value FROM json_each(:brokerageNames));
+            ''', funds)
+            self.cursor.executemany('''
+            INSERT INTO brokerages VALUES (:symbol, :brokerage) ON CONFLICT (symbol, brokerage) DO NOTHING;
+            ''', brokerages)
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
+        return missing
+
+    def bad_symbols(self, symbols: set) -> set:
+        selection = self.cursor.execute('''
+        SELECT symbol FROM badFunds WHERE marked >= :badFundEpoch AND symbol IN (SELECT value FROM json_each(:symbols));
+        ''', {'badFundEpoch': get_bad_fund_epoch_ms(), 'symbols': symbols_parameter(symbols)}).fetchall()
+        return {select[0] for select in selection}
+
+    def existing_symbols(self, symbols: set) -> set:
+        selection = self.cursor.execute('''
+        SELECT symbol FROM funds WHERE symbol IN (SELECT value FROM json_each(:symbols));
+        ''', {'symbols': symbols_parameter(symbols)}).fetchall()
+        return {select[0] for select in selection}
 
     def update_from_ms_finance(self, data):
-        self.cursor.execute('BEGIN TRANSACTION;')
+        self.begin()
         data['unix_time'] = unix_time()
         try:
             rows = self.cursor.execute('SELECT symbol FROM funds WHERE symbol = :symbol;', data)
@@ -236,100 +383,113 @@ class DB:
             else:
                 raise sqlite3.OperationalError(f'symbol {data["symbol"]} is not in the database.')
             self.cursor.execute('UPDATE funds SET msFinanceLastAcquired = :unix_time WHERE :symbol = symbol;', data)
-            self.cursor.execute('COMMIT TRANSACTION;')
+            self.cursor.execute('''
+            UPDATE performanceIds SET verified = :now
+            WHERE symbol = :symbol AND performanceId = (SELECT performanceId FROM funds WHERE symbol = :symbol);
+            ''', {'symbol': data['symbol'], 'now': epoch_ms()})
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
 
-    def update_performance_id(self, data):
-        self.cursor.execute('BEGIN TRANSACTION;')
-        data['unix_time'] = unix_time()
+    def update_performance_ids(self, symbol: str, performance_ids: [dict]) -> set:
+        # Every result whose ticker is a screened fund still without a performanceId is filled in, not only the
+        # symbol that was looked up, and the symbols that got one are returned. The first result for a ticker wins.
+        tickers = {}
+        for data in performance_ids:
+            if data['symbol'] and data['performanceId']:
+                tickers.setdefault(data['symbol'], data)
+        updated = []
+        self.begin()
         try:
-            rows = self.cursor.execute('SELECT symbol FROM funds WHERE symbol = :symbol;', data)
-            if rows.fetchone():
-                self.cursor.execute('''UPDATE funds
+            if not self.existing_symbols({symbol}):
+                raise sqlite3.OperationalError(f'symbol {symbol} is not in the database.')
+            for data in tickers.values():
+                if self.cursor.execute('''UPDATE OR IGNORE funds
                 SET
                     performanceId = :performanceId
-                WHERE :symbol = symbol;''', data)
-            else:
-                raise sqlite3.OperationalError(f'symbol {data["symbol"]} is not in the database.')
-            self.cursor.execute('COMMIT TRANSACTION;')
+                WHERE :symbol = symbol AND performanceId IS NULL;''', data).rowcount:
+                    updated.append(data)
+            self.map_performance_ids(updated)
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
-
-    def valid_for_yh_finance_view(self) -> set:
-        sql = '''
-        SELECT symbol FROM funds WHERE yhFinanceLastAcquired IS NULL OR yhFinanceLastAcquired <= :lastMonthEpoch;
+        return {data['symbol'] for data in updated}
+
+    def map_performance_ids(self, mappings: [dict]):
+        now = epoch_ms()
+        self.cursor.executemany('''
+        INSERT INTO performanceIds (symbol, performanceId, acquired, verified)
+        VALUES (:symbol, :performanceId, :now, :now)
+        ON CONFLICT (symbol) DO UPDATE SET performanceId = excluded.performanceId, acquired = excluded.acquired,
+            verified = excluded.verified;
+        ''', [{'symbol': data['symbol'], 'performanceId': data['performanceId'], 'now': now} for data in mappings])
+
+    def restore_performance_ids(self, symbols: set):
+        # A performanceId already held by another fund is left alone; that fund's lookup decides which one is right.
+        self.cursor.execute('''
+        UPDATE OR IGNORE funds SET performanceId = performanceIds.performanceId
+        FROM performanceIds
+        WHERE funds.performanceId IS NULL AND funds.symbol = performanceIds.symbol
+        AND performanceIds.verified >= :verifiedEpoch AND funds.symbol IN (SELECT value FROM json_each(:symbols));
+        ''', {'verifiedEpoch': get_epoch_from_ms(months=PERFORMANCE_ID_TTL_MONTHS),
+              'symbols': symbols_parameter(symbols)})
+
+    def valid_for_yh_finance_view(self, symbols: set = None) -> set:
+        return self.stage_view(f'''
+        (yhFinanceLastAcquired IS NULL OR yhFinanceLastAcquired <= :lastMonthEpoch)
+        AND {stage_filters.sql(STAGE_SCREEN)}
+        ''', symbols)
+
+    def valid_for_ms_finance_view(self, symbols: set = None) -> set:
+        return self.stage_view(f'''
+        (msFinanceLastAcquired IS NULL OR msFinanceLastAcquired <= :lastMonthEpoch) AND performanceId IS NOT NULL
+        AND {stage_filters.sql(STAGE_SCREEN)} AND {stage_filters.sql(STAGE_YH, 'yhFinanceLastAcquired')}
+        ''', symbols, 'performanceId')
+
+    def valid_for_perf_id_view(self, symbols: set = None) -> set:
+        # Screened funds get their IDs back from performanceIds first, so this is only what that table cannot answer.
+        return self.stage_view(f'''
+        performanceId IS NULL
+        AND {stage_filters.sql(STAGE_SCREEN)} AND {stage_filters.sql(STAGE_YH, 'yhFinanceLastAcquired')}
+        ''', symbols)
+
+    def stage_view(self, eligible: str, symbols: set = None, column: str = 'symbol') -> set:
+        # Eligibility and the user's filter are answered by one query so only the selected column leaves SQLite. The
+        # CTE's column list names valid_funds.sql's one column symbol, whatever the query calls it.
+        if not valid_funds_sql():
+            return set()
+        sql = f'''
+        WITH valid_funds (symbol) AS (
+            {valid_funds_sql()}
+        )
+        SELECT {column} FROM funds WHERE {eligible} AND symbol IN (
+            SELECT valid_funds.symbol FROM valid_funds {symbol_filter(symbols, 'WHERE', 'valid_funds.symbol')}
+        ) AND symbol NOT IN (SELECT symbol FROM badFunds WHERE marked >= :badFundEpoch) {symbol_filter(symbols)};
         '''
-        self.cursor.execute('BEGIN TRANSACTION;')
+        self.read_cursor.execute('BEGIN TRANSACTION;')
         try:
-            selection = self.cursor.execute(sql, {'lastMonthEpoch': get_last_month_epoch_ms()}).fetchall()
-            self.cursor.execute('COMMIT TRANSACTION;')
+            selection = self.read_cursor.execute(sql, filter_parameters(symbols)).fetchall()
+            self.read_cursor.execute('COMMIT TRANSACTION;')
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.read_cursor.execute('ROLLBACK TRANSACTION;')
             raise e
-        selection_set = set()
-        for select in selection:
-            selection_set.add(select[0])
-        return selection_set & self.valid_funds()
+        return {select[0] for select in selection}
 
-    def valid_for_ms_finance_view(self) -> set:
+    def screen_prices(self, quote_type: str) -> [float]:
         sql = '''
-        SELECT symbol, performanceId FROM funds WHERE
-        (msFinanceLastAcquired IS NULL OR msFinanceLastAcquired <= :lastMonthEpoch) AND performanceId IS NOT NULL;
+        SELECT regularMarketPrice FROM funds WHERE quoteType = :quoteType AND regularMarketPrice IS NOT NULL
+        ORDER BY regularMarketPrice;
         '''
-        self.cursor.execute('BEGIN TRANSACTION;')
+        self.read_cursor.execute('BEGIN TRANSACTION;')
         try:
-            selection = self.cursor.execute(sql, {'lastMonthEpoch': get_last_month_epoch_ms()}).fetchall()
-            self.cursor.execute('COMMIT TRANSACTION;')
+            selection = self.read_cursor.execute(sql, {'quoteType': quote_type}).fetchall()
+            self.read_cursor.execute('COMMIT TRANSACTION;')
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.read_cursor.execute('ROLLBACK TRANSACTION;')
             raise e
-        selection_symbols = set()
-        for symbol, _ in selection:
-            selection_symbols.add(symbol)
-        valid_symbols = selection_symbols & self.valid_funds()
-        return_perf_ids = set()
-        for symbol, performance_id in selection:
-            if symbol in valid_symbols:
-                return_perf_ids.add(performance_id)
-        return return_perf_ids
-
-    def valid_for_perf_id_view(self) -> set:
-        sql = '''
-        SELECT symbol FROM funds WHERE performanceId IS NULL;
-        '''
-        self.cursor.execute('BEGIN TRANSACTION;')
-        try:
-            selection = self.cursor.execute(sql).fetchall()
-            self.cursor.execute('COMMIT TRANSACTION;')
-        except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
-            raise e
-        selection_set = set()
-        for select in selection:
-            selection_set.add(select[0])
-        return selection_set & self.valid_funds()
-
-    def valid_funds(self) -> set:
-        # TODO add dynamic filter recognition (1 filter file that automatically filters from screen, yh, & ms)
-        data = {
-            'epoch_ms_ten_years': get_epoch_from_ms(years=10),
-            'lastMonthEpoch': get_last_month_epoch_ms()
-        }
-        sql = utils.valid_funds
-        self.cursor.execute('BEGIN TRANSACTION;')
-        try:
-            selection = self.cursor.execute(sql, data).fetchall()
-            self.cursor.execute('COMMIT TRANSACTION;')
-        except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
-            raise e
-        return_selection = set()
-        for item in selection:
-            return_selection.add(item[0])
-        return return_selection
+        return [select[0] for select in selection]
 
     def csv_data(self):
         data = {
@@ -339,12 +499,12 @@ class DB:
         }
         valid_funds_sql = utils.valid_funds
         sql = utils.output_funds.format(valid_funds_sql=valid_funds_sql)
-        self.cursor.execute('BEGIN TRANSACTION;')
+        self.read_cursor.execute('BEGIN TRANSACTION;')
         try:
-            selection = self.cursor.execute(sql, data).fetchall()
-            self.cursor.execute('COMMIT TRANSACTION;')
+            selection = self.read_cursor.execute(sql, data).fetchall()
+            self.read_cursor.execute('COMMIT TRANSACTION;')
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.read_cursor.execute('ROLLBACK TRANSACTION;')
             raise e
         return selection
 
@@ -352,15 +512,19 @@ class DB:
         sql = '''
         DELETE FROM funds WHERE lastScreened <= :lastMonthEpoch;
         '''
-        self.cursor.execute('BEGIN TRANSACTION;')
+        self.begin()
         try:
             self.cursor.execute(sql, {'lastMonthEpoch': get_last_month_epoch_ms()})
-            self.cursor.execute('COMMIT TRANSACTION;')
+            self.cursor.execute('DELETE FROM performanceIds WHERE verified < :verifiedEpoch;',
+                                {'verifiedEpoch': get_epoch_from_ms(months=PERFORMANCE_ID_TTL_MONTHS)})
+            self.cursor.execute('DELETE FROM badFunds WHERE marked < :badFundEpoch;',
+                                {'badFundEpoch': get_bad_fund_epoch_ms()})
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
             raise e
 
-    def delete_fund(self, symbol, perf_id):
+    def delete_fund(self, symbol, perf_id, reason: str = None):
         if symbol:
             sql = '''
             DELETE FROM funds WHERE symbol = :symbol;
@@ -371,13 +535,147 @@ class DB:
             '''
         else:
             raise Exception('Bad Input to Delete Fund')
-        self.cursor.execute('BEGIN TRANSACTION;')
+        data = {'symbol': symbol, 'performanceId': perf_id, 'reason': reason, 'now': epoch_ms()}
+        self.begin()
         try:
-            self.cursor.execute(sql, {'symbol': symbol, 'performanceId': perf_id})
-            self.cursor.execute('COMMIT TRANSACTION;')
+            self.cursor.execute('''
+            INSERT INTO badFunds (symbol, performanceId, reason, marked)
+            SELECT symbol, performanceId, :reason, :now FROM funds
+            WHERE symbol = :symbol OR (:symbol IS NULL AND performanceId = :performanceId)
+            ON CONFLICT (symbol) DO UPDATE SET performanceId = excluded.performanceId, reason = excluded.reason,
+                marked = excluded.marked;
+            ''', data)
+            if perf_id:
+                self.cursor.execute('DELETE FROM performanceIds WHERE performanceId = :performanceId;', data)
+            self.cursor.execute(sql, data)
+            self.commit()
         except Exception as e:
-            self.cursor.execute('ROLLBACK TRANSACTION;')
+            self.rollback()
+            raise e
+
+    # region Jobs
+    def add_jobs(self, stage: str, entries: set, priority: float):
+        now = epoch_ms()
+        jobs = [{'stage': stage, 'entry': entry, 'priority': priority, 'now': now} for entry in entries]
+        self.begin()
+        try:
+            self.cursor.executemany('''INSERT INTO jobs (stage, entry, priority, nextRunAt, created)
+            VALUES (:stage, :entry, :priority, :now, :now) ON CONFLICT (stage, entry) DO NOTHING;''', jobs)
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            raise e
+
+    def claim_jobs(self, stage: str, entries: set = None, max_attempts: int = None) -> [tuple]:
+        # Leases the claimable jobs of a stage to this run and returns their (entry, attempts, nextRunAt).
+        now = epoch_ms()
+        data = {'stage': stage, 'now': now, 'leaseExpires': now + LEASE_DURATION_MS,
+                'symbols': symbols_parameter(entries), 'maxAttempts': max_attempts}
+        sql = '''
+        UPDATE jobs SET leaseExpires = :leaseExpires
+        WHERE stage = :stage AND (leaseExpires IS NULL OR leaseExpires <= :now)
+        AND (:maxAttempts IS NULL OR attempts < :maxAttempts)
+        '''
+        if entries is not None:
+            sql += ' AND entry IN (SELECT value FROM json_each(:symbols))'
+        sql += ' RETURNING entry, attempts, nextRunAt;'
+        self.begin()
+        try:
+            selection = self.cursor.execute(sql, data).fetchall()
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            raise e
+        return selection
+
+    def retry_job(self, stage: str, entry: str, attempts: int, delay: float):
+        sql = '''
+        UPDATE jobs SET attempts = :attempts, nextRunAt = :nextRunAt WHERE stage = :stage AND entry = :entry;
+        '''
+        self.begin()
+        try:
+            self.cursor.execute(sql, {'stage': stage, 'entry': entry, 'attempts': attempts,
+                                      'nextRunAt': epoch_ms() + int(delay * 1000)})
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            raise e
+
+    def complete_job(self, stage: str, entry: str):
+        self.begin()
+        try:
+            self.cursor.execute('DELETE FROM jobs WHERE stage = :stage AND entry = :entry;',
+                                {'stage': stage, 'entry': entry})
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            raise e
+
+    def withdraw_jobs(self, stage: str, entries: set) -> set:
+        self.begin()
+        try:
+            selection = self.cursor.execute('''
+            DELETE FROM jobs WHERE stage = :stage AND entry IN (SELECT value FROM json_each(:entries)) RETURNING entry;
+            ''', {'stage': stage, 'entries': symbols_parameter(entries)}).fetchall()
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            raise e
+        return {select[0] for select in selection}
+
+    def performance_ids(self, symbols: set) -> set:
+        # A bad fund's row is gone by now, but badFunds kept its performanceId.
+        selection = self.cursor.execute('''
+        SELECT performanceId FROM funds WHERE performanceId IS NOT NULL
+        AND symbol IN (SELECT value FROM json_each(:symbols))
+        UNION
+        SELECT performanceId FROM badFunds WHERE performanceId IS NOT NULL
+        AND symbol IN (SELECT value FROM json_each(:symbols));
+        ''', {'symbols': symbols_parameter(symbols)}).fetchall()
+        return {select[0] for select in selection}
+
+    def release_leases(self):
+        # Only one crawler runs against a database, so every lease left at start-up belongs to a dead run.
+        self.begin()
+        try:
+            self.cursor.execute('UPDATE jobs SET leaseExpires = NULL WHERE leaseExpires IS NOT NULL;')
+            self.cursor.execute('DELETE FROM jobs WHERE created <= :lastMonthEpoch;',
+                                {'lastMonthEpoch': get_last_month_epoch_ms()})
+            self.commit()
+        except Exception as e:
+            self.rollback()
             raise e
+    # endregion
+
+
+def symbol_filter(symbols: set, keyword: str = 'AND', column: str = 'symbol') -> str:
+    if symbols is None:
+        return ''
+    return f'{keyword} {column} IN (SELECT value FROM json_each(:symbols))'
+
+
+def valid_funds_sql() -> str:
+    # Nested in the stage views, so trailing comment lines and the final ';' are dropped. The views close it on a new
+    # line, so a comment ending its last line cannot swallow the ')'.
+    lines = utils.valid_funds.strip().splitlines()
+    while lines and (not lines[-1].strip() or lines[-1].strip().startswith('--')):
+        lines.pop()
+    return re.sub(r';(\s*--[^\n]*)?$', r'\1', '\n'.join(lines).rstrip())
+
+
+def filter_parameters(symbols: set = None) -> dict:
+    return {
+        'epoch_ms_ten_years': get_epoch_from_ms(years=10),
+        'lastMonthEpoch': get_last_month_epoch_ms(),
+        'badFundEpoch': get_bad_fund_epoch_ms(),
+        'symbols': symbols_parameter(symbols)
+    } | stage_filters.parameters()
+
+
+def symbols_parameter(symbols: set):
+    if symbols is None:
+        return None
+    return json.dumps(sorted(symbols))
 
 
 def function_regex(value, pattern):
@@ -385,6 +683,10 @@ def function_regex(value, pattern):
     return c_pattern.search(fr'\b{value.lower()}\b') is not None
 
 
+def epoch_ms():
+    return int(time.time() * 1000)
+
+
 def unix_time():
     return int(time.time_ns() / 1000)
 
@@ -396,6 +698,10 @@ def get_last_month_epoch_ms():
     return int(last_month.timestamp() * 1000)
 
 
+def get_bad_fund_epoch_ms():
+    return get_epoch_from_ms(months=BAD_FUND_TTL_MONTHS)
+
+
 def get_epoch_from_ms(days=0, months=0, years=0):
     today = datetime.datetime.today() - relativedelta(years=years, months=months, days=days)
     return int(today.timestamp() * 1000)
@@ -0,0 +1,118 @@
+import datetime
+import json
+import operator
+
+from dateutil.relativedelta import relativedelta
+
+import utils
+
+STAGE_SCREEN = 'screen'
+STAGE_YH = 'yh'
+STAGE_MS = 'ms'
+
+# Columns a filter can test, by the stage whose response fills them in.
+STAGE_FIELDS = {
+    STAGE_SCREEN: ['longName', 'quoteType', 'firstTradeDateMilliseconds', 'exchange', 'market', 'marketCap',
+                   'marketState', 'priceHint', 'priceToBook', 'regularMarketChange', 'regularMarketChangePercent',
+                   'regularMarketPreviousClose', 'regularMarketPrice', 'sharesOutstanding', 'tradeable',
+                   'triggerable'],
+    STAGE_YH: ['ytd', 'lastBearMkt', 'lastBullMkt', 'oneMonth', 'threeMonth', 'oneYear', 'threeYear', 'fiveYear',
+               'tenYear', 'beta3Year', 'category', 'totalAssets', 'fundFamily', 'yield', 'twelveBOne'],
+    STAGE_MS: ['starRating']
+}
+# Response dictionaries that name a field differently from its column.
+RESPONSE_KEYS = {'yield': 'percent_yield'}
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, values: value in values,
+    'not in': lambda value, values: value not in values
+}
+
+
+class Predicate:
+    def __init__(self, field: str, op: str, value, name: str):
+        if op not in OPERATORS:
+            raise FilterError(f'Unknown operator {op} for {field}.')
+        if op in ('in', 'not in') and not isinstance(value, list):
+            raise FilterError(f'{field} {op} needs a list of values.')
+        self.field = field
+        self.op = op
+        self.value = relative_value(value)
+        self.name = name
+
+    def accepts(self, data: dict) -> bool:
+        # Matches SQL: a missing value or one of another type never satisfies the predicate.
+        value = data.get(RESPONSE_KEYS.get(self.field, self.field))
+        if value is None:
+            return False
+        try:
+            return OPERATORS[self.op](value, self.value)
+        except TypeError:
+            return False
+
+    def sql(self) -> str:
+        if self.op == 'in':
+            return f'"{self.field}" IN (SELECT value FROM json_each(:{self.name}))'
+        if self.op == 'not in':
+            return f'"{self.field}" NOT IN (SELECT value FROM json_each(:{self.name}))'
+        return f'"{self.field}" {self.op} :{self.name}'
+
+    def parameter(self):
+        if self.op in ('in', 'not in'):
+            return json.dumps(self.value)
+        return self.value
+
+
+class Filters:
+    # Compiled form of data/filters.json: a list of {"field", "op", "value"} entries that all have to hold. Each
+    # predicate belongs to the stage whose response carries its field, so a fund can be dropped as soon as that
+    # response arrives.
+    def __init__(self, definitions: [dict]):
+        field_stages = {field: stage for stage, fields in STAGE_FIELDS.items() for field in fields}
+        self.stages = {stage: [] for stage in STAGE_FIELDS}
+        for i, definition in enumerate(definitions):
+            field = definition['field']
+            if field not in field_stages:
+                raise FilterError(f'{field} cannot be filtered on.')
+            self.stages[field_stages[field]].append(
+                Predicate(field, definition['op'], definition['value'], f'filter{i}'))
+
+    def accepts(self, stage: str, data: dict) -> bool:
+        return all(predicate.accepts(data) for predicate in self.stages[stage])
+
+    def sql(self, stage: str, acquired_column: str = None) -> str:
+        # With acquired_column a fund passes until that stage's data for this month is in, since it is only
+        # excluded once the data proves it.
+        if not self.stages[stage]:
+            return '1'
+        clause = ' AND '.join(predicate.sql() for predicate in self.stages[stage])
+        if acquired_column is None:
+            return f'({clause})'
+        return f'({acquired_column} IS NULL OR {acquired_column} <= :lastMonthEpoch OR ({clause}))'
+
+    def parameters(self) -> dict:
+        return {predicate.name: predicate.parameter() for predicates in self.stages.values()
+                for predicate in predicates}
+
+
+def relative_value(value):
+    # {"years_ago": 10} style values become an epoch in milliseconds, like firstTradeDateMilliseconds.
+    if isinstance(value, dict):
+        moment = datetime.datetime.today() - relativedelta(years=value.get('years_ago', 0),
+                                                           months=value.get('months_ago', 0),
+                                                           days=value.get('days_ago', 0))
+        return int(moment.timestamp() * 1000)
+    return value
+
+
+class FilterError(Exception):
+    pass
+
+
+stage_filters = Filters(utils.filters)
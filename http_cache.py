@@ -0,0 +1,96 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+from typing import Optional
+
+CREATE_RESPONSES_TABLE = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    storedAt INTEGER NOT NULL,
+    usedAt INTEGER NOT NULL,
+    PRIMARY KEY (key)
+);
+'''
+
+CREATE_RESPONSES_INDEX = '''CREATE INDEX IF NOT EXISTS responses_used_at ON responses (usedAt);'''
+
+# Least recently used responses beyond the newest max_bytes worth are dropped.
+EVICT_RESPONSES = '''
+DELETE FROM responses WHERE key IN (
+    SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY usedAt DESC, key) AS kept FROM responses)
+    WHERE kept > :maxBytes
+);
+'''
+
+# Eviction trims to this share of the limit so it does not run again on the very next store.
+EVICT_TO = .9
+
+
+class HTTPCache:
+    # Response bodies by request, kept compressed on disk for the month they were fetched in. Data is refreshed
+    # monthly, so anything stored before the current month is stale and is never served.
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode = WAL;')
+        self.connection.execute('PRAGMA synchronous = NORMAL;')
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(CREATE_RESPONSES_TABLE)
+        self.cursor.execute(CREATE_RESPONSES_INDEX)
+        self.cursor.execute('DELETE FROM responses WHERE storedAt < :monthEpoch;', {'monthEpoch': month_epoch_ms()})
+        self.connection.commit()
+        self.size = self.cursor.execute('SELECT COALESCE(SUM(size), 0) FROM responses;').fetchone()[0]
+
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self.cursor.execute('SELECT body FROM responses WHERE key = :key AND storedAt >= :monthEpoch;',
+                                  {'key': key, 'monthEpoch': month_epoch_ms()}).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cursor.execute('UPDATE responses SET usedAt = :now WHERE key = :key;', {'key': key, 'now': epoch_ms()})
+        self.connection.commit()
+        return zlib.decompress(row[0])
+
+    def put(self, key: str, payload: bytes):
+        body = zlib.compress(payload)
+        now = epoch_ms()
+        replaced = self.cursor.execute('SELECT size FROM responses WHERE key = :key;', {'key': key}).fetchone()
+        self.cursor.execute('''
+            INSERT INTO responses (key, body, size, storedAt, usedAt) VALUES (:key, :body, :size, :now, :now)
+            ON CONFLICT(key) DO UPDATE SET body = excluded.body, size = excluded.size, storedAt = excluded.storedAt,
+                usedAt = excluded.usedAt;''', {'key': key, 'body': body, 'size': len(body), 'now': now})
+        self.size += len(body) - (replaced[0] if replaced else 0)
+        if self.size > self.max_bytes:
+            self.cursor.execute(EVICT_RESPONSES, {'maxBytes': int(self.max_bytes * EVICT_TO)})
+            self.size = self.cursor.execute('SELECT COALESCE(SUM(size), 0) FROM responses;').fetchone()[0]
+        self.connection.commit()
+
+    def stats(self) -> str:
+        return f'HTTP cache: {self.hits} hits, {self.misses} misses, {self.size} bytes.'
+
+
+def request_key(method: str, url: str, params: dict = None, body=None) -> str:
+    body_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest() if body is not None else ''
+    query = json.dumps({key: str(value) for key, value in (params or {}).items()}, sort_keys=True)
+    return hashlib.sha256(f'{method.upper()} {url} {query} {body_hash}'.encode()).hexdigest()
+
+
+def month_epoch_ms() -> int:
+    month = datetime.datetime.today().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(month.timestamp() * 1000)
+
+
+def epoch_ms() -> int:
+    return int(time.time() * 1000)
@@ -1,23 +1,106 @@
+import asyncio
+import contextvars
 import json
+import time
+from concurrent.futures import Executor
+from typing import Optional
 
-import requests
+import aiohttp
+from yarl import URL
 
+import metrics
 import utils
 from utils import logger
+from parsers import decode
+from http_cache import HTTPCache, request_key
 
-TIMEOUT = 30
+TIMEOUT = aiohttp.ClientTimeout(total=30)
+# Idle connections are kept this long so a stage that pauses for its rate limiter does not pay for a new handshake.
+KEEPALIVE_TIMEOUT: float = 60
+DNS_CACHE_TTL: int = 300
+
+YH_HOST = "yh-finance.p.rapidapi.com"
+MS_HOST = "ms-finance.p.rapidapi.com"
+
+# Pointed at benchmarks/mock_api.py to run the pipeline without spending quota. The two APIs need different origins,
+# since rate limits are looked up by the origin of each response.
+YH_BASE_URL = utils.settings['yh_base_url'].rstrip('/')
+MS_BASE_URL = utils.settings['ms_base_url'].rstrip('/')
+YH_ORIGIN = str(URL(YH_BASE_URL).origin())
+MS_ORIGIN = str(URL(MS_BASE_URL).origin())
 
 YH_HEADERS = {
     'content-type': "application/json",
-    'X-RapidAPI-Host': "yh-finance.p.rapidapi.com",
+    'accept-encoding': "gzip, deflate",
+    'X-RapidAPI-Host': YH_HOST,
     'X-RapidAPI-Key': utils.settings['api_key']
 }
 
 MS_HEADERS = {
-    'X-RapidAPI-Host': "ms-finance.p.rapidapi.com",
+    'accept-encoding': "gzip, deflate",
+    'X-RapidAPI-Host': MS_HOST,
     'X-RapidAPI-Key': utils.settings['api_key']
 }
 
+# Origin -> rate limiter that is fed the status and rate-limit headers of every response from that host.
+rate_limits = {}
+
+# When set, response bodies are decoded and parsed in this pool instead of on the event loop.
+parse_pool: Optional[Executor] = None
+
+# When set, get-summary, auto-complete and get-detail responses are served from and stored in this cache.
+response_cache: Optional[HTTPCache] = None
+# Whether the last cached_get of the current task was answered by response_cache, i.e. cost no API call.
+from_cache = contextvars.ContextVar('from_cache', default=False)
+# Seconds the last request of the current task spent on the network and parsing its body, for profiling.
+network_seconds = contextvars.ContextVar('network_seconds', default=0.0)
+parse_seconds = contextvars.ContextVar('parse_seconds', default=0.0)
+
+
+class TransportStats:
+    def __init__(self):
+        self.connections = 0
+        self.reused = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_create)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuse)
+        return trace_config
+
+    async def on_connection_create(self, session, context, params):
+        self.connections += 1
+
+    async def on_connection_reuse(self, session, context, params):
+        self.reused += 1
+
+    def record(self, response: aiohttp.ClientResponse, payload: bytes):
+        # Content-Length is the compressed size; a chunked response has none and is counted as decoded.
+        self.wire_bytes += response.content_length if response.content_length is not None else len(payload)
+        self.body_bytes += len(payload)
+
+    def stats(self) -> str:
+        return (f'HTTP transport: {self.connections} connections opened, {self.reused} reused, '
+                f'{self.wire_bytes} bytes on the wire for {self.body_bytes} bytes of body.')
+
+
+transport_stats = TransportStats()
+
+
+def open_session(origin_connections: {str: int}) -> aiohttp.ClientSession:
+    # One session for every API, so the screen and the yh stage share the yh-finance connections and the perf and
+    # ms stages share the ms-finance ones. A worker has one request in flight at a time, so an origin never uses more
+    # connections than it has workers; the pool caps the total at the sum of them and any one host at the largest.
+    global transport_stats
+    transport_stats = TransportStats()
+    connector = aiohttp.TCPConnector(limit=sum(origin_connections.values()),
+                                     limit_per_host=max(origin_connections.values()),
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL)
+    return aiohttp.ClientSession(connector=connector, timeout=TIMEOUT,
+                                 trace_configs=[transport_stats.trace_config()])
+
 
 # region Payloads
 def default_payload(operator: str, operands: []) -> json:
@@ -53,46 +136,86 @@ def btwn_payload(floor: float, roof: float) -> json:
 
 # endregion
 
-def get_screen(session: requests.Session, quote_type: str, offset: int, payload: json):
-    url = "https://yh-finance.p.rapidapi.com/screeners/list"
+async def get_screen(session: aiohttp.ClientSession, quote_type: str, offset: int, payload: json, parse=decode):
+    url = f'{YH_BASE_URL}/screeners/list'
     querystring = {"quoteType": quote_type, "sortField": "intradayprice", "region": "US", "size": "50",
                    "offset": offset,
                    "sortType": "ASC"}
-    return validate_response(session.post(url, json=payload, headers=YH_HEADERS, params=querystring, timeout=TIMEOUT))
+    started, sent = time.perf_counter(), asyncio.get_running_loop().time()
+    async with session.post(url, json=payload, headers=YH_HEADERS, params=querystring, timeout=TIMEOUT) as response:
+        return await validate_response(response, parse, started=started, sent=sent)
 
 
-def get_yh_info(session: requests.Session, symbol: str):
-    url = "https://yh-finance.p.rapidapi.com/stock/v2/get-summary"
+async def get_yh_info(session: aiohttp.ClientSession, symbol: str, parse=decode):
+    url = f'{YH_BASE_URL}/stock/v2/get-summary'
     querystring = {"symbol": symbol, "region": "US"}
-    return validate_response(session.get(url, headers=YH_HEADERS, params=querystring, timeout=TIMEOUT))
+    return await cached_get(session, url, YH_HEADERS, querystring, parse)
 
 
-def get_perf_id(session: requests.Session, symbol: str):
-    url = "https://ms-finance.p.rapidapi.com/market/v2/auto-complete"
+async def get_perf_id(session: aiohttp.ClientSession, symbol: str, parse=decode):
+    url = f'{MS_BASE_URL}/market/v2/auto-complete'
     querystring = {"q": symbol}
-    return validate_response(session.get(url, headers=MS_HEADERS, params=querystring, timeout=TIMEOUT))
+    return await cached_get(session, url, MS_HEADERS, querystring, parse)
 
 
-def get_ms_info(session: requests.Session, performance_id: str):
-    url = "https://ms-finance.p.rapidapi.com/stock/get-detail"
+async def get_ms_info(session: aiohttp.ClientSession, performance_id: str, parse=decode):
+    url = f'{MS_BASE_URL}/stock/get-detail'
     querystring = {"PerformanceId": performance_id}
-    return validate_response(session.get(url, headers=MS_HEADERS, params=querystring, timeout=TIMEOUT))
-
-
-def validate_response(response):
+    return await cached_get(session, url, MS_HEADERS, querystring, parse)
+
+
+async def cached_get(session: aiohttp.ClientSession, url: str, headers: dict, params: dict, parse=decode):
+    cache_key = None
+    from_cache.set(False)
+    if response_cache is not None:
+        cache_key = request_key('GET', url, params)
+        payload = response_cache.get(cache_key)
+        if payload is not None:
+            from_cache.set(True)
+            metrics.responses.inc(endpoint=URL(url).path, status='cache')
+            return await parse_payload(parse, payload)
+    started, sent = time.perf_counter(), asyncio.get_running_loop().time()
+    async with session.get(url, headers=headers, params=params, timeout=TIMEOUT) as response:
+        return await validate_response(response, parse, cache_key, started, sent)
+
+
+async def validate_response(response: aiohttp.ClientResponse, parse=decode, cache_key: str = None,
+                            started: float = None, sent: float = None):
+    metrics.responses.inc(endpoint=response.url.path, status=response.status)
+    rate_limiter = rate_limits.get(str(response.url.origin()))
+    if rate_limiter is not None:
+        rate_limiter.observe(response.status, response.headers, sent)
     try:
         response.raise_for_status()
-        json_response = response.json()
-        if json_response:
-            return json_response
-        else:
-            return -1
+        payload = await response.read()
+        transport_stats.record(response, payload)
+        if started is not None:
+            network_seconds.set(time.perf_counter() - started)
+            metrics.request_seconds.observe(network_seconds.get(), endpoint=response.url.path)
+        parsed = await parse_payload(parse, payload)
+        # Only bodies that parsed are kept, so a garbled response is fetched again next time.
+        if cache_key is not None:
+            response_cache.put(cache_key, payload)
+        return parsed
     except Exception as e:
         logger.exception(f'{response.headers}, {e}')
         return None
 
 
+async def parse_payload(parse, payload: bytes):
+    started = time.perf_counter()
+    try:
+        if parse_pool is None:
+            return parse(payload)
+        return await asyncio.get_running_loop().run_in_executor(parse_pool, parse, payload)
+    finally:
+        parse_seconds.set(time.perf_counter() - started)
+
+
+async def _test():
+    async with open_session({MS_ORIGIN: 1}) as test_session:
+        print(await get_ms_info(test_session, '0P0001LD1Y'))
+
+
 if __name__ == '__main__':
-    test_session = requests.Session()
-    print((test_session, '0P0001LD1Y'))
-    # print(get_perf_id(('UNL',)))
+    asyncio.run(_test())
@@ -1,23 +1,37 @@
+import asyncio
 import csv
+import itertools
+import multiprocessing
 import threading
-from queue import Queue, PriorityQueue
-from time import sleep
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Queue
 
-import requests
+import aiohttp
 
 import database
+import http_requests
 import mail
+import metrics
+import profiling
 import utils
 from utils import logger
+from rate_limiter import TokenBucket
+from retry_policy import CircuitBreaker, backoff_delay, MAX_ATTEMPTS
+from scheduler import Scheduler
+from filters import stage_filters, STAGE_SCREEN, STAGE_YH
+from screen_planner import ScreenBand, plan_bands, QUOTE_TYPES, MAX_TOTAL, MAX_RESULTS
+from http_cache import HTTPCache
 from http_requests import get_screen, gt_payload, btwn_payload, get_yh_info, get_perf_id, get_ms_info
-from structures import ScreenerResponse, MSFinanceResponse, YHFinanceResponse, PerformanceIdResponse
-
-MAX_WORKERS = 5
+from parsers import BadPayload, parse_screen, parse_yh, parse_perf_ids, parse_ms
+from structures import ScreenerResponse, MSFinanceResponse, YHFinanceResponse
 
 db_write_queue = Queue()
 
-yh_queue = PriorityQueue()
-ms_queue = PriorityQueue()
+# Created per run in run_pipeline so they are bound to the running event loop.
+yh_queue: asyncio.PriorityQueue
+ms_queue: asyncio.PriorityQueue
 
 SCREEN_PRIORITY = 0
 YH_PRIORITY = 0.5
@@ -25,174 +39,340 @@ PERF_ID_PRIORITY = 0
 MS_PRIORITY = 0.5
 DEATH_PRIORITY = 10
 
-MAX_TOTAL: int = 5000
-DEFAULT_JUMP: int = 250
-DEFAULT_FLOOR: int = -1
-MAX_RESULTS: int = 50
-DEFAULT_DELAYS = [0, 1, 5, 10, 60, 300, 600]
+STAGE_PRIORITIES = {'yh': YH_PRIORITY, 'perf': PERF_ID_PRIORITY, 'ms': MS_PRIORITY}
+# Stage each worker method reports its results under.
+METRIC_STAGES = {'screen_fund': 'screen', 'fetch_yh_fund': 'yh', 'fetch_perf_id': 'perf', 'fetch_ms_fund': 'ms'}
+
+STATUS_INTERVAL: float = 30
+CHECKPOINT_INTERVAL: float = 10
 
-yh_screen_dynamic_total = 0
-yh_screen_dynamic_total_lock = threading.Lock()
-yh_screen_dynamic_total_update_event = threading.Event()
+scheduler: Scheduler
 
-yh_api_calls_lock = threading.Lock()
-ms_api_calls_lock = threading.Lock()
+work_sequence = itertools.count()
 
 kill_event = threading.Event()
 
 unchecked_exceptions = []
 
-program_ended = False
-
 
 class DataTree:
-    def __init__(self, parent=None, data_source=''):
+    def __init__(self, parent=None, data_source='', dependencies=()):
         self.parent: [DataTree, None] = parent
         if parent is not None:
             parent.children.append(self)
         self.children = []
         self.data_source = data_source
-        self.data = []
-        self.event = threading.Event()
+        # Every stage whose writes can make entries eligible for this one, not just the parent.
+        self.dependencies: [DataTree] = ([parent] if parent is not None else []) + list(dependencies)
+        self.dependents: [DataTree] = []
+        for dependency in self.dependencies:
+            dependency.dependents.append(self)
+        self.inbox = {}
+        self.items: {str: WorkItem} = {}
+        self.pending = 0
+        self.changed = asyncio.Event()
+        self.flushed = False
+        self.loop: [asyncio.AbstractEventLoop, None] = None
         self.incomplete = True
 
+    def push(self, jobs: {str: tuple}):
+        # Called from the db thread with the jobs this run just claimed for the stage, as entry: (attempts, nextRunAt).
+        if jobs:
+            self.loop.call_soon_threadsafe(self.receive, jobs)
+
+    def receive(self, jobs: {str: tuple}):
+        self.inbox.update(jobs)
+        self.changed.set()
+
+    def withdraw(self, entries: set):
+        # Called from the db thread with entries whose jobs were dropped, e.g. after their fund was filtered out.
+        if entries:
+            self.loop.call_soon_threadsafe(self.drop, entries)
+
+    def drop(self, entries: set):
+        for entry in entries:
+            self.inbox.pop(entry, None)
+            item = self.items.pop(entry, None)
+            if item is not None:
+                item.cancelled = True
+                self.pending -= 1
+        self.changed.set()
+
+    def settle(self, item) -> bool:
+        # An item that was dropped while in flight has already been taken off pending.
+        if self.items.pop(item.args[0], None) is None:
+            return False
+        self.pending -= 1
+        self.changed.set()
+        return True
+
+    def finish(self, item):
+        if self.settle(item):
+            db_write_queue.put(JobDone(self.data_source, item.args[0]))
+
+    def retry(self, item, delay: float):
+        db_write_queue.put(JobUpdate(self.data_source, item.args[0], item.attempts, delay))
+
+    def abandon(self, item):
+        if self.settle(item):
+            db_write_queue.put(JobUpdate(self.data_source, item.args[0], item.attempts, None))
+
+    def complete(self):
+        # Called once the db thread has applied every write from this stage and pushed the entries they unlocked.
+        self.flushed = True
+        for dependent in self.dependents:
+            dependent.changed.set()
+
+    def ready_to_finish(self) -> bool:
+        return self.pending == 0 and not self.inbox and all(dependency.flushed for dependency in self.dependencies)
+
+
+class WriteChanges:
+    def __init__(self):
+        # Symbols whose writes may have made entries eligible, those the filters rejected or an API marked bad on
+        # arrival and those another fund's auto-complete response gave a performanceId.
+        self.symbols = set()
+        self.rejected = set()
+        self.harvested = set()
+
+
+class StageFlush:
+    def __init__(self, data_tree: DataTree):
+        self.data_tree = data_tree
+
+
+class JobDone:
+    def __init__(self, stage: str, entry: str):
+        self.stage = stage
+        self.entry = entry
+
 
-def update_api_calls(access_controllers):
-    for controller in access_controllers:
-        with controller.api_calls_remaining_lock:
-            controller.api_calls_remaining = 1
-            controller.api_calls_remaining_condition.notify()
-    if not program_ended:
-        threading.Timer(.25, update_api_calls, (access_controllers,)).start()
+class JobUpdate:
+    def __init__(self, stage: str, entry: str, attempts: int, delay: [float, None]):
+        self.stage = stage
+        self.entry = entry
+        self.attempts = attempts
+        self.delay = delay
 
 
 class ApiAccessController:
-    def __init__(self):
-        self.api_calls_remaining = 0
-        self.api_calls_remaining_lock = threading.Lock()
-        self.api_calls_remaining_condition = threading.Condition(self.api_calls_remaining_lock)
-        self.failures = 0
-        self.failures_lock = threading.Lock()
+    def __init__(self, workers: int, rate_limiter: TokenBucket):
+        self.workers = workers
+        self.rate_limiter = rate_limiter
+        self.breakers = {}
+        # Items held while their breaker is open, as (queue, priority, item), and the breakers with a probe timer.
+        self.parked: {CircuitBreaker: deque} = {}
+        self.probing = set()
+
+    async def acquire(self):
+        await self.rate_limiter.acquire()
+
+    def breaker(self, method) -> CircuitBreaker:
+        if method not in self.breakers:
+            self.breakers[method] = CircuitBreaker(method.__name__)
+        return self.breakers[method]
+
+    def park(self, breaker: CircuitBreaker, queue: asyncio.PriorityQueue, priority: float, item):
+        # One timer per breaker brings a single parked item back for the half-open probe; the rest wait for it to
+        # close the circuit rather than all waking at the reset time and bouncing off it.
+        self.parked.setdefault(breaker, deque()).append((queue, priority, item))
+        self.schedule_probe(breaker)
+
+    def schedule_probe(self, breaker: CircuitBreaker):
+        if breaker not in self.probing and self.parked.get(breaker):
+            self.probing.add(breaker)
+            scheduler.call_later(breaker.retry_in(), self.release_probe, breaker)
+
+    def release_probe(self, breaker: CircuitBreaker):
+        self.probing.discard(breaker)
+        parked = self.parked.get(breaker)
+        if parked:
+            requeue(*parked.popleft())
+
+    def release(self, breaker: CircuitBreaker):
+        for parked in self.parked.pop(breaker, ()):
+            requeue(*parked)
+
+
+class WorkItem:
+    def __init__(self, method, args: tuple, source: DataTree = None):
+        self.method = method
+        self.args = args
+        self.source = source
+        self.attempts = 0
+        self.cancelled = False
+        self.queued_at: [float, None] = None
+
+    def __str__(self):
+        return f'{getattr(self.method, "__name__", None)}{self.args}'
+
+
+def enqueue(queue: asyncio.PriorityQueue, priority: float, item: WorkItem):
+    # The sequence number keeps equal priorities FIFO and stops the items themselves from being compared.
+    item.queued_at = time.perf_counter()
+    queue.put_nowait((priority, next(work_sequence), item))
 
 
-def worker_thread(
+def requeue(queue: asyncio.PriorityQueue, priority: float, item: WorkItem):
+    # The item's original get is only marked done once it is back in the queue, so queue.join() keeps waiting
+    # for items that are backing off.
+    enqueue(queue, priority, item)
+    queue.task_done()
+
+
+async def worker(
         name,
-        work_queue: PriorityQueue,
+        work_queue: asyncio.PriorityQueue,
         db_queue: Queue,
         api_access_controller: ApiAccessController,
-        session: requests.Session):
+        session: aiohttp.ClientSession):
     try:
         while not kill_event.is_set():
-            try:
-                sleep(DEFAULT_DELAYS[api_access_controller.failures // MAX_WORKERS])
-            except IndexError:
-                print(f'Too many errors occurred in {name}. Aborting.')
-                logger.exception(f'Too many errors occurred in {name}. Aborting.')
-
-            priority, content = work_queue.get()
-            method, args = content
-            if method is None:
+            priority, _, item = await work_queue.get()
+            if item.method is None:
                 work_queue.task_done()
-                session.close()
-                logger.debug('Thread Complete.')
+                logger.debug(f'{name} Complete.')
                 return
-            with api_access_controller.api_calls_remaining_lock:
-                while api_access_controller.api_calls_remaining <= 0:
-                    api_access_controller.api_calls_remaining_condition.wait()
-                api_access_controller.api_calls_remaining -= 1
-            method_return = method(*args, session=session)
+            if item.cancelled:
+                work_queue.task_done()
+                continue
+            breaker = api_access_controller.breaker(item.method)
+            if not breaker.allow():
+                api_access_controller.park(breaker, work_queue, priority, item)
+                continue
+            await api_access_controller.acquire()
+            called = time.perf_counter()
+            http_requests.network_seconds.set(0.0)
+            http_requests.parse_seconds.set(0.0)
+            try:
+                method_return = await item.method(*item.args, session=session)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f'Request failed in {name}. Item: {item}. Exception: {e!r}')
+                method_return = None
+            stage = METRIC_STAGES.get(item.method.__name__, item.method.__name__)
+            if profiling.profiler is not None:
+                profiling.profiler.stage_times.record(stage, called - item.queued_at,
+                                                      http_requests.network_seconds.get(),
+                                                      http_requests.parse_seconds.get(), time.perf_counter() - called)
             if method_return is None:
-                with api_access_controller.failures_lock:
-                    api_access_controller.failures += 1
-                    logger.error(
-                        f'''Bad return in {name}.
-                            Failures: {api_access_controller.failures}.
-                            Priority: {priority}.
-                            Content: {content}.''')
-                    work_queue.put((priority + 1, content))
+                metrics.results.inc(stage=stage, result='failure')
+                breaker.record_failure()
+                # A failed probe reopens the circuit; the parked items need the next one even if this item gives up.
+                api_access_controller.schedule_probe(breaker)
+                item.attempts += 1
+                if item.attempts >= MAX_ATTEMPTS:
+                    logger.error(f'Giving up in {name} after {item.attempts} attempts. Item: {item}.')
+                    if item.source is not None:
+                        item.source.abandon(item)
+                    work_queue.task_done()
+                    continue
+                delay = backoff_delay(item.attempts)
+                logger.error(
+                    f'''Bad return in {name}.
+                        Attempts: {item.attempts}.
+                        Priority: {priority}.
+                        Retry in: {delay:.1f}s.
+                        Item: {item}.''')
+                if item.source is not None:
+                    item.source.retry(item, delay)
+                scheduler.call_later(delay, requeue, work_queue, priority, item)
             else:
-                api_access_controller.failures = 0  # Race conditions do not matter
+                metrics.results.inc(stage=stage, result='bad_fund' if isinstance(method_return, BadFund) else 'success')
+                breaker.record_success()
+                api_access_controller.release(breaker)
                 db_queue.put(method_return)
-            work_queue.task_done()
+                if item.source is not None:
+                    item.source.finish(item)
+                work_queue.task_done()
     except Exception as unchecked_exception:
         unchecked_exceptions.append(unchecked_exception)
         raise unchecked_exception
 
 
-def drop_roof(floor, roof, rate_of_approach=4):
-    return roof - (roof - floor) / rate_of_approach
-
-
-def screen_master(data_tree: DataTree):
+def request_page(band: ScreenBand, offset: int) -> asyncio.Future:
+    item = WorkItem(screen_fund, (band, offset), band)
+    band.items[offset] = item
+    enqueue(yh_queue, SCREEN_PRIORITY, item)
+    return band.page(offset)
+
+
+async def screen_band(band: ScreenBand, bands: [ScreenBand], window: int):
+    # Keeps up to `window` pages of the band in flight. The page limit starts from the planned estimate and is
+    # corrected by every page's total; queued pages past the corrected limit are cancelled before they spend quota.
+    in_flight = set()
+    next_offset = 0
+    while True:
+        limit = band.limit()
+        band.cancel_beyond(limit)
+        in_flight = {page for page in in_flight if not page.cancelled()}
+        while len(in_flight) < window and next_offset < limit:
+            in_flight.add(request_page(band, next_offset))
+            next_offset += MAX_RESULTS
+        if not in_flight:
+            break
+        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for page in done:
+            if not page.cancelled() and page.exception() is not None:
+                raise page.exception()
+    logger.debug(f'Band {band} complete. Expected: {band.expected}. Total: {band.total}.')
+    band.done = True
+    follow_up = band.follow_up()
+    if follow_up is not None:
+        logger.debug(f'Band {band} exceeded {MAX_TOTAL}. Continuing with {follow_up}.')
+        bands.append(follow_up)
+    save_screen_bands(band.quote_type, bands)
+    if follow_up is not None:
+        await screen_band(follow_up, bands, window)
+
+
+def save_screen_bands(screen_state: str, bands: [ScreenBand]):
+    utils.progress['screen'][screen_state]['bands'] = [band.to_dict() for band in bands]
+
+
+def load_screen_bands(screen_state: str) -> [ScreenBand]:
+    if utils.progress['screen'][screen_state]['bands']:
+        logger.debug(f'Picking up {screen_state} from left off.')
+        return [ScreenBand.from_dict(screen_state, band) for band in utils.progress['screen'][screen_state]['bands']]
+    db = database.DB()
     try:
-        global yh_screen_dynamic_total
-        if utils.progress['screen_state'] == utils.STATE_FINISHED:
-            data_tree.incomplete = False
-            logger.debug('Screen Complete')
-            return
-
-        with requests.Session() as session:
-            for screen_state in [utils.STATE_MUTUAL_FUND, utils.STATE_ETF]:
-                if utils.progress['screen_state'] == screen_state:
-                    logger.debug('Picking up from left off.')
-                    current_floor = utils.progress['floor']
-                    starting_offset = utils.progress['offset']
-                elif screen_state == utils.STATE_MUTUAL_FUND and utils.progress['screen_state'] == utils.STATE_ETF:
-                    logger.debug('Skipping Mutual Funds.')
-                    continue
-                else:
-                    current_floor = DEFAULT_FLOOR
-                    starting_offset = 0
-
-                utils.progress['screen_state'] = screen_state
-
-                remaining_total = MAX_TOTAL + 1
-                while remaining_total > MAX_TOTAL:
-                    current_roof = current_floor + DEFAULT_JUMP
-                    screen_result = screen_fund(screen_state, starting_offset, current_floor, session=session)
-                    screen_result_dict = screen_result.to_dict()
-                    remaining_total = screen_result_dict['total']
-
-                    db_write_queue.put(screen_result)
-
-                    yh_screen_dynamic_total_lock.acquire()
-                    yh_screen_dynamic_total = remaining_total
-                    yh_screen_dynamic_total_lock.release()
-
-                    utils.progress['floor'] = current_floor
-
-                    yh_screen_dynamic_total_update_event.set()
-                    for bottom_offset in range(starting_offset, MAX_TOTAL, MAX_RESULTS * MAX_WORKERS):
-                        utils.progress['offset'] = bottom_offset
-                        utils.dump_progress()
-
-                        while not yh_screen_dynamic_total_update_event.wait(5):
-                            if kill_event.is_set():
-                                return
-                        yh_screen_dynamic_total_update_event.clear()
-                        yh_screen_dynamic_total_lock.acquire()
-                        logger.debug(f'{bottom_offset}/{yh_screen_dynamic_total}:{remaining_total}')
-                        if yh_screen_dynamic_total > MAX_TOTAL:
-                            current_roof = drop_roof(current_floor, current_roof)
-
-                        if bottom_offset > yh_screen_dynamic_total:
-                            yh_screen_dynamic_total_lock.release()
-                            break
-                        else:
-                            yh_screen_dynamic_total_lock.release()
-
-                        for offset_mod in range(0, MAX_RESULTS * MAX_WORKERS, MAX_RESULTS):
-                            logger.debug(
-                                f'''yh_queue.put:screen_fund:{screen_state}:{bottom_offset + offset_mod}:{current_floor}
-                                :{current_roof}:{offset_mod == 0}''')
-                            yh_queue.put((SCREEN_PRIORITY, (screen_fund, (
-                                screen_state, bottom_offset + offset_mod, current_floor, current_roof, offset_mod == 0
-                            ))))
-                    current_floor = current_roof
-                    starting_offset = 0
-        utils.progress['screen_state'] = utils.STATE_FINISHED
+        db.create_tables()
+        prices = db.screen_prices(QUOTE_TYPES[screen_state])
+    finally:
+        db.close_connections()
+    bands = plan_bands(screen_state, prices)
+    logger.debug(f'Planned {len(bands)} {screen_state} bands from {len(prices)} prices.')
+    return bands
+
+
+async def screen_quote_type(screen_state: str, window: int):
+    cursor = utils.progress['screen'][screen_state]
+    if cursor['state'] == utils.STATE_FINISHED:
+        logger.debug(f'Skipping {screen_state}.')
+        return
+    bands = load_screen_bands(screen_state)
+    cursor['state'] = utils.STATE_SCREENING
+    save_screen_bands(screen_state, bands)
+    results = await asyncio.gather(*[screen_band(band, bands, window) for band in bands if not band.done],
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    cursor['state'] = utils.STATE_FINISHED
+    cursor['bands'] = []
+    logger.debug(f'{screen_state} Screen Complete')
+
+
+async def screen_master(data_tree: DataTree, window: int):
+    # Each quote type keeps its own cursor in progress.json, so both are screened at once and resume independently.
+    try:
+        results = await asyncio.gather(*[screen_quote_type(screen_state, window) for screen_state in QUOTE_TYPES],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
         utils.dump_progress()
         data_tree.incomplete = False
+        db_write_queue.put(StageFlush(data_tree))
         logger.debug('Screen Complete')
     except Exception as unchecked_exception:
         unchecked_exceptions.append(unchecked_exception)
@@ -200,231 +380,470 @@ def screen_master(data_tree: DataTree):
 
 
 class BadFund:
-    def __init__(self, symbol=None, perf_id=None):
-        logger.debug(f'Symbol/Perf_id {symbol}/{perf_id} is bad.')
+    def __init__(self, symbol=None, perf_id=None, reason: str = None):
+        logger.debug(f'Symbol/Perf_id {symbol}/{perf_id} is bad: {reason}.')
         self.symbol = symbol
         self.perf_id = perf_id
+        self.reason = reason
 
     def __str__(self):
         return self.symbol
 
 
-def screen_fund(screen_type: str, offset: int, floor: int, roof=None, updater=True, **kwargs) -> {}:
-    global yh_screen_dynamic_total
+class PerformanceIdLookup:
+    def __init__(self, symbol: str, responses: list):
+        # Every result of the auto-complete call for symbol, its own included.
+        self.symbol = symbol
+        self.responses = responses
+
+
+async def screen_fund(band: ScreenBand, offset: int, **kwargs) -> {}:
     session = kwargs['session']
-    if roof is None:
-        payload = gt_payload(floor)
+    if band.roof is None:
+        payload = gt_payload(band.floor)
     else:
-        payload = btwn_payload(floor, roof)
+        payload = btwn_payload(band.floor, band.roof)
 
-    screen_data = get_screen(session, screen_type, offset, payload)
-    if screen_data is None:
+    screener_response = await get_screen(session, band.quote_type, offset, payload, parse_screen)
+    if screener_response is None:
         return None
-    screener_response = ScreenerResponse(screen_data)
-    with yh_api_calls_lock:
-        utils.progress['yh_api_calls'] += 1
-        if utils.progress['yh_api_calls'] >= utils.settings['max_yh_calls']:
-            raise MaxCallsExceededError('Max yh calls exceeded.')
-
-    if updater:
-        yh_screen_dynamic_total_lock.acquire()
-        yh_screen_dynamic_total = screener_response.to_dict()['total']
-        yh_screen_dynamic_total_update_event.set()
-        yh_screen_dynamic_total_lock.release()
+    count_api_call('yh')
 
+    band.record(offset, screener_response.total,
+                [quote.regularMarketPrice for quote in screener_response.quotes
+                 if quote.regularMarketPrice is not None])
     return screener_response
 
 
-def fetch_yh_fund(fund, **kwargs):
+async def fetch_yh_fund(fund, **kwargs):
     session = kwargs['session']
-    data = get_yh_info(session, fund)
-    if data is None:
+    yh_finance_response = await get_yh_info(session, fund, parse_yh)
+    if yh_finance_response is None:
         return None
+    count_api_call('yh', http_requests.from_cache.get())
+    if isinstance(yh_finance_response, BadPayload):
+        return BadFund(symbol=fund, reason=yh_finance_response.reason)
+    return yh_finance_response
 
-    try:
-        yh_finance_response = YHFinanceResponse(data)
-        with yh_api_calls_lock:
-            utils.progress['yh_api_calls'] += 1
-            if utils.progress['yh_api_calls'] >= utils.settings['max_yh_calls']:
-                raise MaxCallsExceededError('Max yh calls exceeded.')
-        if 'err' in yh_finance_response.defaultKeyStatistics.data:
-            return BadFund(symbol=fund)
-        return yh_finance_response
-    except KeyError:
-        logger.debug(data)
-        return BadFund(symbol=fund)
-
-
-def fetch_perf_id(fund, **kwargs):
+
+async def fetch_perf_id(fund, **kwargs):
     session = kwargs['session']
-    data = get_perf_id(session, fund)
-    if data is None:
+    performance_ids = await get_perf_id(session, fund, parse_perf_ids)
+    if performance_ids is None:
         return None
-    result = None
-    for entry in data['results']:
-        if entry['ticker'] == fund:
-            result = entry
-            break
-    if result is None:
-        return BadFund(symbol=fund)
-    with ms_api_calls_lock:
-        utils.progress['ms_api_calls'] += 1
-        if utils.progress['ms_api_calls'] >= utils.settings['max_ms_calls']:
-            raise MaxCallsExceededError('Max ms calls exceeded.')
-    return PerformanceIdResponse(result)
+    if isinstance(performance_ids, BadPayload):
+        return BadFund(symbol=fund, reason=performance_ids.reason)
+    if fund not in {result.symbol for result in performance_ids.results}:
+        return BadFund(symbol=fund, reason='no auto-complete match')
+    count_api_call('ms', http_requests.from_cache.get())
+    return PerformanceIdLookup(fund, performance_ids.results)
 
 
-def fetch_ms_fund(fund, **kwargs):
+async def fetch_ms_fund(fund, **kwargs):
     session = kwargs['session']
-    data = get_ms_info(session, fund)
-    if data is None:
+    ms_finance_response = await get_ms_info(session, fund, parse_ms)
+    if ms_finance_response is None:
         return None
-    if data == -1 or 'symbol' not in data[0]:
-        return BadFund(perf_id=fund)
-    with ms_api_calls_lock:
-        utils.progress['ms_api_calls'] += 1
-        if utils.progress['ms_api_calls'] >= utils.settings['max_ms_calls']:
-            raise MaxCallsExceededError('Max ms calls exceeded.')
-    return MSFinanceResponse(data[0])
+    if isinstance(ms_finance_response, BadPayload):
+        return BadFund(perf_id=fund, reason=ms_finance_response.reason)
+    count_api_call('ms', http_requests.from_cache.get())
+    return ms_finance_response
+
+
+def count_api_call(api: str, cached: bool = False):
+    # Responses served from the http cache cost nothing, so they do not count towards the monthly limit.
+    if cached:
+        return
+    utils.progress[f'{api}_api_calls'] += 1
+    if utils.progress[f'{api}_api_calls'] >= utils.settings[f'max_{api}_calls']:
+        raise MaxCallsExceededError(f'Max {api} calls exceeded.')
 
 
 class MaxCallsExceededError(Exception):
     pass
 
 
-def master_thread(queue: PriorityQueue, priority: float, data_source: DataTree, worker):
+async def master(queue: asyncio.PriorityQueue, priority: float, data_source: DataTree, worker_method, workers: int):
     try:
         already_queued = set()
-        data = [1]
-        while data_source.parent.incomplete or len(data) > 0:
+        while not data_source.ready_to_finish():
             if kill_event.is_set():
                 return
-            data_source.event.wait()
-            data = data_source.data
-            data_source.event.clear()
-            for entry in data:
+            await data_source.changed.wait()
+            data_source.changed.clear()
+            jobs = data_source.inbox
+            data_source.inbox = {}
+            for entry, (attempts, next_run_at) in jobs.items():
                 if entry in already_queued:
                     continue
                 already_queued.add(entry)
-                queue.put((priority, (worker, (entry,))))
+                data_source.pending += 1
+                item = WorkItem(worker_method, (entry,), data_source)
+                item.attempts = attempts
+                data_source.items[entry] = item
+                delay = next_run_at / 1000 - time.time()
+                if delay > 0:
+                    scheduler.call_later(delay, enqueue, queue, priority, item)
+                else:
+                    enqueue(queue, priority, item)
         if len(data_source.children) == 0:
-            for _ in range(0, MAX_WORKERS):
-                queue.put((DEATH_PRIORITY, (None, None)))
-            queue.join()
+            for _ in range(0, workers):
+                enqueue(queue, DEATH_PRIORITY, WorkItem(None, ()))
+            await queue.join()
         data_source.incomplete = False
-        logger.debug(f'Thread Complete.')
+        db_write_queue.put(StageFlush(data_source))
+        logger.debug(f'{data_source.data_source} master Complete. Queued: {len(already_queued)}.')
     except Exception as unchecked_exception:
         unchecked_exceptions.append(unchecked_exception)
         raise unchecked_exception
 
 
+def stage_view(db: database.DB, tree: DataTree, symbols: set = None) -> set:
+    if tree.data_source == 'yh':
+        return db.valid_for_yh_finance_view(symbols)
+    elif tree.data_source == 'perf':
+        return db.valid_for_perf_id_view(symbols)
+    elif tree.data_source == 'ms':
+        return db.valid_for_ms_finance_view(symbols)
+    return set()
+
+
+def push_eligible(db: database.DB, data_trees: [DataTree], symbols: set = None):
+    # Records what the given symbols made eligible as jobs and hands the claimed ones to their stage.
+    for tree in data_trees:
+        if not tree.flushed:
+            entries = stage_view(db, tree, symbols)
+            db.add_jobs(tree.data_source, entries, STAGE_PRIORITIES[tree.data_source])
+            push_claimed(db, tree, entries)
+
+
+def push_claimed(db: database.DB, tree: DataTree, entries: set = None):
+    jobs = db.claim_jobs(tree.data_source, entries, MAX_ATTEMPTS)
+    tree.push({entry: (attempts, next_run_at) for entry, attempts, next_run_at in jobs})
+
+
+def load_jobs(db: database.DB, data_trees: [DataTree]):
+    # Every start reconciles the full stage views into the job table. Existing jobs keep their attempts and backoff,
+    # and anything a crash left eligible without a job, e.g. between a batch commit and its push_eligible, gets one.
+    db.release_leases()
+    for tree in data_trees:
+        db.add_jobs(tree.data_source, stage_view(db, tree), STAGE_PRIORITIES[tree.data_source])
+        push_claimed(db, tree)
+
+
+def is_control(write_queue_value) -> bool:
+    return write_queue_value is None or isinstance(write_queue_value, StageFlush)
+
+
+def next_write_batch(batch_size: int, latency: float) -> list:
+    # Blocks for the first value, then drains until the batch is full or its latency budget is spent. A control
+    # value closes the batch so everything queued before it is committed first.
+    batch = [db_write_queue.get()]
+    deadline = time.monotonic() + latency
+    while len(batch) < batch_size and not is_control(batch[-1]):
+        timeout = deadline - time.monotonic()
+        try:
+            if timeout > 0:
+                batch.append(db_write_queue.get(timeout=timeout))
+            else:
+                batch.append(db_write_queue.get_nowait())
+        except Empty:
+            break
+    return batch
+
+
+def write_value(db: database.DB, write_queue_value, changes: WriteChanges):
+    if isinstance(write_queue_value, PerformanceIdLookup):
+        updated = db.update_performance_ids(write_queue_value.symbol,
+                                            [response.to_dict() for response in write_queue_value.responses])
+        changes.symbols.update(updated)
+        changes.harvested.update(updated - {write_queue_value.symbol})
+    elif isinstance(write_queue_value, MSFinanceResponse):
+        data = write_queue_value.to_dict()
+        db.update_from_ms_finance(data)
+        changes.symbols.add(data['symbol'])
+    elif isinstance(write_queue_value, JobDone):
+        db.complete_job(write_queue_value.stage, write_queue_value.entry)
+    elif isinstance(write_queue_value, JobUpdate):
+        attempts = write_queue_value.attempts
+        if write_queue_value.delay is None:
+            logger.debug(f'Job {write_queue_value.stage}:{write_queue_value.entry} is dead.')
+            attempts = MAX_ATTEMPTS
+        db.retry_job(write_queue_value.stage, write_queue_value.entry, attempts, write_queue_value.delay or 0)
+    elif isinstance(write_queue_value, BadFund):
+        logger.debug(f'Bad Fund: {write_queue_value.symbol}/{write_queue_value.perf_id}')
+        db.delete_fund(write_queue_value.symbol, write_queue_value.perf_id, write_queue_value.reason)
+        if write_queue_value.symbol is not None:
+            changes.rejected.add(write_queue_value.symbol)
+
+
+def write_bulk(db: database.DB, values: list, changes: WriteChanges):
+    # Consecutive screener pages and yh responses are written with one set-based statement per table. Every quote
+    # is stored, since band planning needs its price, but only those the filters accept can unlock later stages.
+    if isinstance(values[0], ScreenerResponse):
+        quotes = [quote.to_dict() for value in values for quote in value.quotes]
+        db.add_from_screener(quotes)
+        stage, funds = STAGE_SCREEN, quotes
+    else:
+        funds = [value.to_dict() for value in values]
+        stage = STAGE_YH
+        try:
+            missing = db.update_from_yh_finance(funds)
+        except Exception:
+            changes.symbols.update(data['symbol'] for data in funds)
+            raise
+        if missing:
+            logger.error(f'Symbols {sorted(missing)} are not in the database.')
+            changes.symbols.update(missing)
+            funds = [data for data in funds if data['symbol'] not in missing]
+    for data in funds:
+        if stage_filters.accepts(stage, data):
+            changes.symbols.add(data['symbol'])
+        else:
+            changes.rejected.add(data['symbol'])
+
+
+def write_logged(write, db: database.DB, value, changes: WriteChanges):
+    try:
+        write(db, value, changes)
+    except Exception as e:
+        logger.exception(f'Value: {value}, Exception: {e}')
+
+
+def write_batch(db: database.DB, batch: list, changes: WriteChanges):
+    # One transaction per batch; a write that fails is rolled back to its own savepoint and logged.
+    db.begin_batch()
+    try:
+        for value_type, values in itertools.groupby(batch, type):
+            if value_type in (ScreenerResponse, YHFinanceResponse):
+                values = list(values)
+                started = time.perf_counter()
+                write_logged(write_bulk, db, values, changes)
+                profile_db(values[0], started)
+            else:
+                for write_queue_value in values:
+                    started = time.perf_counter()
+                    write_logged(write_value, db, write_queue_value, changes)
+                    profile_db(write_queue_value, started)
+    finally:
+        db.commit_batch()
+
+
+def profile_db(write_queue_value, started: float):
+    if profiling.profiler is None:
+        return
+    if isinstance(write_queue_value, (JobDone, JobUpdate)):
+        stage = write_queue_value.stage
+    elif isinstance(write_queue_value, BadFund):
+        stage = 'bad_fund'
+    else:
+        stage = {ScreenerResponse: 'screen', YHFinanceResponse: 'yh', PerformanceIdLookup: 'perf',
+                 MSFinanceResponse: 'ms'}.get(type(write_queue_value), 'other')
+    profiling.profiler.stage_times.record_db(stage, time.perf_counter() - started)
+
+
+def withdraw_symbols(db: database.DB, data_trees: [DataTree], symbols: set, reason: str):
+    # Jobs that no longer need their API call, because the fund was filtered out, went bad or its data already
+    # arrived some other way, are dropped before they cost one.
+    for tree in data_trees:
+        entries = db.performance_ids(symbols) if tree.data_source == 'ms' else symbols
+        withdrawn = db.withdraw_jobs(tree.data_source, entries)
+        if withdrawn:
+            logger.debug(f'Withdrew {len(withdrawn)} {tree.data_source} jobs for {reason} funds.')
+        tree.withdraw(withdrawn)
+
+
 def manage_db(data_trees):
     try:
+        if profiling.profiler is not None:
+            profiling.profiler.register('db')
         db = database.DB()
         db.create_tables()
+        load_jobs(db, data_trees)
+        changes = WriteChanges()
         while True:
-            write_queue_value = None
+            batch = next_write_batch(utils.settings['db_batch_size'], utils.settings['db_batch_latency'])
+            control = batch.pop() if is_control(batch[-1]) else False
             try:
-                for tree in data_trees:
-                    if not tree.event.is_set():
-                        if tree.data_source == 'yh':
-                            tree.data = db.valid_for_yh_finance_view()
-                            tree.event.set()
-                        elif tree.data_source == 'perf':
-                            tree.data = db.valid_for_perf_id_view()
-                            tree.event.set()
-                        elif tree.data_source == 'ms':
-                            tree.data = db.valid_for_ms_finance_view()
-                            tree.event.set()
-                while not db_write_queue.empty():
-                    write_queue_value = db_write_queue.get()
-                    if write_queue_value is None:
-                        db_write_queue.task_done()
-                        db.delete_unscreened()
-                        db.close_connections()
-                        logger.debug('DB Thread is complete.')
-                        return
-                    if isinstance(write_queue_value, ScreenerResponse):
-                        db.add_from_screener(write_queue_value.to_dict()['quotes'])
-                    elif isinstance(write_queue_value, YHFinanceResponse):
-                        db.update_from_yh_finance(write_queue_value.to_dict())
-                    elif isinstance(write_queue_value, PerformanceIdResponse):
-                        db.update_performance_id(write_queue_value.to_dict())
-                    elif isinstance(write_queue_value, MSFinanceResponse):
-                        db.update_from_ms_finance(write_queue_value.to_dict())
-                    elif isinstance(write_queue_value, BadFund):
-                        logger.debug(f'Bad Fund: {write_queue_value.symbol}/{write_queue_value.perf_id}')
-                        db.delete_fund(write_queue_value.symbol, write_queue_value.perf_id)
-                    db_write_queue.task_done()
+                if batch:
+                    started = time.perf_counter()
+                    write_batch(db, batch, changes)
+                    metrics.db_batch_seconds.observe(time.perf_counter() - started)
+                    metrics.db_batch_values.inc(len(batch))
+                if changes.rejected:
+                    withdraw_symbols(db, data_trees, changes.rejected, 'filtered or bad')
+                    changes.rejected = set()
+                if changes.harvested:
+                    withdraw_symbols(db, [tree for tree in data_trees if tree.data_source == 'perf'],
+                                     changes.harvested, 'harvested')
+                    changes.harvested = set()
+                if control is None:
+                    db.delete_unscreened()
+                    db.close_connections()
+                    logger.debug('DB Thread is complete.')
+                    return
+                if isinstance(control, StageFlush):
+                    # A failed push fails the run, and the tree is completed regardless so the stages waiting on it
+                    # end rather than hang; the next start reconciles whatever jobs the push missed.
+                    try:
+                        if changes.symbols:
+                            push_eligible(db, data_trees, changes.symbols)
+                            changes.symbols = set()
+                    except Exception as flush_exception:
+                        unchecked_exceptions.append(flush_exception)
+                        raise flush_exception
+                    finally:
+                        control.data_tree.loop.call_soon_threadsafe(control.data_tree.complete)
+                if changes.symbols and db_write_queue.empty():
+                    push_eligible(db, data_trees, changes.symbols)
+                    changes.symbols = set()
             except Exception as e:
-                logger.exception(f'Value: {write_queue_value}, Exception: {e}')
+                logger.exception(f'Batch: {len(batch)} values, Control: {control}, Exception: {e}')
+            finally:
+                for _ in range(len(batch) + (control is not False)):
+                    db_write_queue.task_done()
     except Exception as unchecked_exception:
         unchecked_exceptions.append(unchecked_exception)
         raise unchecked_exception
 
 
-def debug_aid(*args):
-    print_str = 'Threads Status: '
-    alive_thread = False
-    for arg in args:
-        alive_thread = alive_thread or arg.is_alive()
-        print_str += f'|{arg.name}, {arg.is_alive()}|'
-    logger.debug(print_str)
-    if not program_ended or alive_thread:
-        threading.Timer(30, debug_aid, args).start()
-
-
-def main() -> bool:
-    global program_ended, unchecked_exceptions
+def debug_aid(db_thread: threading.Thread, tasks: [asyncio.Task]):
+    print_str = f'Tasks Status: |{db_thread.name}, {db_thread.is_alive()}|'
+    for task in tasks:
+        print_str += f'|{task.get_name()}, {not task.done()}|'
+    logger.debug(f'{print_str} Scheduled: {scheduler.pending()}')
+    logger.debug(http_requests.transport_stats.stats())
+    if http_requests.response_cache is not None:
+        logger.debug(http_requests.response_cache.stats())
+
+
+# Quota burn and stage completion rates between exports.
+api_call_rates = {api: metrics.Rate() for api in ('yh', 'ms')}
+stage_rates = {stage: metrics.Rate() for stage in METRIC_STAGES.values()}
+
+
+def export_metrics(data_trees: [DataTree]):
+    # Queue depths, pending work, quota and ETAs are sampled here rather than tracked on every change.
+    now = time.monotonic()
+    metrics.queue_depth.set(yh_queue.qsize(), queue='yh')
+    metrics.queue_depth.set(ms_queue.qsize(), queue='ms')
+    metrics.queue_depth.set(db_write_queue.qsize(), queue='db_write')
+    for api, rate in api_call_rates.items():
+        calls, limit = utils.progress[f'{api}_api_calls'], utils.settings[f'max_{api}_calls']
+        metrics.api_calls.set(calls, api=api)
+        metrics.api_call_limit.set(limit, api=api)
+        burn = rate.sample(calls, now)
+        if burn is not None:
+            metrics.api_call_rate.set(burn, api=api)
+            metrics.quota_eta.set((limit - calls) / burn if burn > 0 else float('inf'), api=api)
+    for tree in data_trees:
+        metrics.stage_pending.set(tree.pending, stage=tree.data_source)
+        done = metrics.results.total(stage=tree.data_source, result='success') + \
+            metrics.results.total(stage=tree.data_source, result='bad_fund')
+        completion = stage_rates[tree.data_source].sample(done, now)
+        if completion is not None:
+            metrics.stage_eta.set(tree.pending / completion if completion > 0 else float('inf'),
+                                  stage=tree.data_source)
+    metrics.registry.write(utils.METRICS_FILE)
+
+
+async def run_pipeline() -> bool:
+    global yh_queue, ms_queue, scheduler, unchecked_exceptions
     success = True
+    scheduler = Scheduler()
+    yh_queue = asyncio.PriorityQueue()
+    ms_queue = asyncio.PriorityQueue()
+    if utils.settings['profile_threads'] or utils.settings['profile_allocations']:
+        profiling.profiler = profiling.Profiler(utils.PROFILE_DIR, utils.settings['profile_threads'],
+                                                utils.settings['profile_interval'],
+                                                utils.settings['profile_allocations'], METRIC_STAGES)
+        profiling.profiler.start()
+        profiling.profiler.register('loop')
+
     screen_data_tree = DataTree()
     yh_data_tree = DataTree(screen_data_tree, 'yh')
-    perf_id_data_tree = DataTree(screen_data_tree, 'perf')
-    ms_data_tree = DataTree(perf_id_data_tree, 'ms')
-
-    yh_access_control = ApiAccessController()
-    ms_access_control = ApiAccessController()
-
-    db_thread = threading.Thread(target=manage_db, name='db_master',
-                                 args=([yh_data_tree, perf_id_data_tree, ms_data_tree],))
-
-    threads = [
-        threading.Thread(target=screen_master, name='screen_master', args=(screen_data_tree,)),
-        threading.Thread(target=master_thread, name='ms_master',
-                         args=(ms_queue, MS_PRIORITY, ms_data_tree, fetch_ms_fund)),
-        threading.Thread(target=master_thread, name='perf_id_master',
-                         args=(ms_queue, PERF_ID_PRIORITY, perf_id_data_tree, fetch_perf_id)),
-        threading.Thread(target=master_thread, name='yh_master',
-                         args=(yh_queue, YH_PRIORITY, yh_data_tree, fetch_yh_fund)),
-    ]
-    for i in range(0, MAX_WORKERS):
-        threads += [
-            threading.Thread(target=worker_thread,
-                             name=f'yh_worker_{i}',
-                             args=(f'yh_worker_{i}', yh_queue, db_write_queue, yh_access_control, requests.Session())),
-            threading.Thread(target=worker_thread,
-                             name=f'ms_worker_{i}',
-                             args=(f'ms_worker_{i}', ms_queue, db_write_queue, ms_access_control, requests.Session()))
+    perf_id_data_tree = DataTree(screen_data_tree, 'perf', [yh_data_tree])
+    ms_data_tree = DataTree(perf_id_data_tree, 'ms', [yh_data_tree])
+    stage_trees = [yh_data_tree, perf_id_data_tree, ms_data_tree]
+    for tree in [screen_data_tree] + stage_trees:
+        tree.loop = asyncio.get_running_loop()
+
+    yh_access_control = ApiAccessController(utils.settings['yh_workers'], TokenBucket(
+        utils.settings['yh_rate'], utils.settings['yh_burst'], utils.settings['yh_max_rate']))
+    ms_access_control = ApiAccessController(utils.settings['ms_workers'], TokenBucket(
+        utils.settings['ms_rate'], utils.settings['ms_burst'], utils.settings['ms_max_rate']))
+    http_requests.rate_limits[http_requests.YH_ORIGIN] = yh_access_control.rate_limiter
+    http_requests.rate_limits[http_requests.MS_ORIGIN] = ms_access_control.rate_limiter
+
+    if utils.settings['http_cache_bytes'] > 0:
+        http_requests.response_cache = HTTPCache(utils.HTTP_CACHE_FILE, utils.settings['http_cache_bytes'])
+    if utils.settings['parse_processes'] > 0:
+        # forkserver children start clean rather than inheriting the event loop, sessions and db thread.
+        http_requests.parse_pool = ProcessPoolExecutor(utils.settings['parse_processes'],
+                                                       mp_context=multiprocessing.get_context('forkserver'))
+
+    db_thread = threading.Thread(target=manage_db, name='db_master', args=(stage_trees,))
+
+    async with http_requests.open_session({http_requests.YH_ORIGIN: yh_access_control.workers,
+                                           http_requests.MS_ORIGIN: ms_access_control.workers}) as session:
+        tasks = [
+            asyncio.create_task(screen_master(screen_data_tree, utils.settings['screen_window']),
+                                name='screen_master'),
+            asyncio.create_task(master(ms_queue, MS_PRIORITY, ms_data_tree, fetch_ms_fund,
+                                       ms_access_control.workers), name='ms_master'),
+            asyncio.create_task(master(ms_queue, PERF_ID_PRIORITY, perf_id_data_tree, fetch_perf_id,
+                                       ms_access_control.workers), name='perf_id_master'),
+            asyncio.create_task(master(yh_queue, YH_PRIORITY, yh_data_tree, fetch_yh_fund,
+                                       yh_access_control.workers), name='yh_master'),
         ]
-
-    update_api_calls([yh_access_control, ms_access_control])
-    debug_aid(db_thread, *threads)
-    db_thread.start()
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        while thread.is_alive():
-            thread.join(5)
+        for i in range(0, yh_access_control.workers):
+            tasks.append(asyncio.create_task(
+                worker(f'yh_worker_{i}', yh_queue, db_write_queue, yh_access_control, session),
+                name=f'yh_worker_{i}'))
+        for i in range(0, ms_access_control.workers):
+            tasks.append(asyncio.create_task(
+                worker(f'ms_worker_{i}', ms_queue, db_write_queue, ms_access_control, session),
+                name=f'ms_worker_{i}'))
+
+        scheduler.call_every(STATUS_INTERVAL, debug_aid, db_thread, tasks)
+        scheduler.call_every(CHECKPOINT_INTERVAL, utils.dump_progress)
+        if utils.settings['metrics_interval'] > 0:
+            scheduler.call_every(utils.settings['metrics_interval'], export_metrics, stage_trees)
+        scheduler_task = asyncio.create_task(scheduler.run(), name='scheduler')
+        db_thread.start()
+        pending = set(tasks)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=5)
             if len(unchecked_exceptions) > 0:
                 kill_event.set()
-                program_ended = True
                 utils.dump_progress()
                 mail.debug_email(unchecked_exceptions)
                 unchecked_exceptions = []
                 success = False
+                for task in pending:
+                    task.cancel()
+        scheduler_task.cancel()
+        utils.dump_progress()
+        if utils.settings['metrics_interval'] > 0:
+            export_metrics(stage_trees)
+    logger.info(http_requests.transport_stats.stats())
+    if http_requests.parse_pool is not None:
+        http_requests.parse_pool.shutdown(cancel_futures=True)
+        http_requests.parse_pool = None
+    if http_requests.response_cache is not None:
+        logger.info(http_requests.response_cache.stats())
+        http_requests.response_cache.close()
+        http_requests.response_cache = None
     db_write_queue.put(None)
-    db_thread.join()
-    program_ended = True
+    await asyncio.to_thread(db_thread.join)
+    if profiling.profiler is not None:
+        profiling.profiler.stop()
+        profiling.profiler = None
+    return success
+
+
+def main() -> bool:
+    success = asyncio.run(run_pipeline())
     if success:
         db = database.DB()
         csv_data = db.csv_data()
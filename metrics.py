@@ -0,0 +1,139 @@
+import bisect
+import math
+import os
+from typing import Optional
+
+# Counters, gauges and histograms in the Prometheus text format, written to a file that node_exporter's textfile
+# collector (or anyone with cat) can read. Each metric is written to by one thread at a time and read by the
+# exporter, so recording is a dict update and nothing is locked.
+
+REQUEST_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+
+
+def label_text(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = ''
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def samples(self) -> [tuple]:
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        lines += [f'{name}{label_text(labels)} {number(value)}' for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels) -> float:
+        # Sum over every series whose labels include the given ones.
+        wanted = set(labels.items())
+        return sum(value for key, value in self.values.items() if wanted <= set(key))
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> [tuple]:
+        samples = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + (('le', number(bucket)),), cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class Rate:
+    # Per-second rate of a growing total, measured between consecutive samples.
+    def __init__(self):
+        self.last: Optional[tuple] = None
+
+    def sample(self, total: float, now: float) -> Optional[float]:
+        last, self.last = self.last, (total, now)
+        if last is None or now <= last[1]:
+            return None
+        return (total - last[0]) / (now - last[1])
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: [Metric] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def write(self, path: str):
+        # Written aside and renamed so a reader never sees half a file.
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temporary, path)
+
+
+registry = Registry()
+
+request_seconds = registry.add(Histogram('pipeline_request_seconds', 'API request latency by endpoint.',
+                                         REQUEST_BUCKETS))
+responses = registry.add(Counter('pipeline_responses_total', 'API responses by endpoint and status.'))
+results = registry.add(Counter('pipeline_results_total', 'Work items by stage and result (success, bad_fund, '
+                                                        'failure).'))
+db_batch_seconds = registry.add(Histogram('pipeline_db_batch_seconds', 'Time to write and commit one db batch.',
+                                          DB_BUCKETS))
+db_batch_values = registry.add(Counter('pipeline_db_values_total', 'Values written by the db thread.'))
+queue_depth = registry.add(Gauge('pipeline_queue_depth', 'Items waiting in each queue.'))
+stage_pending = registry.add(Gauge('pipeline_stage_pending', 'Entries a stage has taken on and not finished.'))
+stage_eta = registry.add(Gauge('pipeline_stage_eta_seconds', 'Time to finish the pending entries at the current '
+                                                             'rate.'))
+api_calls = registry.add(Gauge('pipeline_api_calls', 'API calls counted towards the monthly limit.'))
+api_call_limit = registry.add(Gauge('pipeline_api_call_limit', 'Monthly API call limit.'))
+api_call_rate = registry.add(Gauge('pipeline_api_calls_per_second', 'Quota burn rate.'))
+quota_eta = registry.add(Gauge('pipeline_quota_eta_seconds', 'Time until the monthly limit at the current burn '
+                                                             'rate.'))
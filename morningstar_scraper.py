@@ -1,6 +1,7 @@
 import re
 
 import requests
+from requests.adapters import HTTPAdapter
 
 HEADERS = {
     'accept': '*/*',
@@ -19,6 +20,10 @@ HEADERS = {
     'x-sal-contenttype': 'e7FDDltrTy+tA2HnLovvGL0LFMwT+KkEptGju5wXVTU='
 }
 
+# One pooled session so the bearer request and every trailing return call reuse the same connections.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 
 def update_bearer():
     global session_bearer
@@ -30,7 +35,7 @@ def update_bearer():
         'FC': 'F000010S65',
         'IT': 'FO',
         'LANG': 'fr-FR'}
-    response = requests.get(url, headers=headers, params=payload)
+    response = session.get(url, headers=headers, params=payload)
     search = re.search('(tokenMaaS:[\w\s]*\")(.*)(\")', response.text, re.IGNORECASE)
     session_bearer = 'Bearer ' + search.group(2)
 
@@ -48,7 +53,7 @@ def get_trailing_returns(performance_id):
         'version': '4.14.0',
     }
 
-    response = requests.get(url, headers=HEADERS | {'authorization': session_bearer}, params=payload)
+    response = session.get(url, headers=HEADERS | {'authorization': session_bearer}, params=payload)
     return response
 
 
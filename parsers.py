@@ -0,0 +1,51 @@
+import json
+
+from structures import ScreenerResponse, MSFinanceResponse, YHFinanceResponse, PerformanceIdResults
+
+
+# Each parser turns a raw response body into the record stored for it. They are plain module-level functions of
+# bytes so http_requests can run them in a worker process and only the compact record is sent back.
+
+class BadPayload:
+    # The API answered, but not with a usable fund.
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+def decode(payload: bytes):
+    if not payload.strip():
+        return -1
+    data = json.loads(payload)
+    if data:
+        return data
+    return -1
+
+
+def parse_screen(payload: bytes) -> ScreenerResponse:
+    return ScreenerResponse(decode(payload))
+
+
+def parse_yh(payload: bytes):
+    data = decode(payload)
+    if data == -1:
+        return BadPayload('empty get-summary')
+    try:
+        if 'err' in data.get('defaultKeyStatistics', data):
+            return BadPayload('get-summary err')
+        return YHFinanceResponse(data)
+    except KeyError:
+        return BadPayload('unreadable get-summary')
+
+
+def parse_perf_ids(payload: bytes):
+    data = decode(payload)
+    if data == -1:
+        return BadPayload('empty auto-complete')
+    return PerformanceIdResults(data)
+
+
+def parse_ms(payload: bytes):
+    data = decode(payload)
+    if data == -1 or 'symbol' not in data[0]:
+        return BadPayload('no get-detail')
+    return MSFinanceResponse(data[0])
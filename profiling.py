@@ -0,0 +1,144 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Optional
+
+from utils import logger
+
+# Sampled rather than traced: sys._current_frames() can be read for just the threads asked for, costs nothing
+# between samples and yields whole stacks, which is what a flame graph needs. cProfile gives neither stacks nor,
+# since 3.12, a profile of one thread alone.
+
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 20
+PARTS = ('wait', 'network', 'parse', 'call', 'db')
+
+
+def frame_name(code) -> str:
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, interval: float, stage_functions: {str: str}, stages: set):
+        super().__init__(name='profiler', daemon=True)
+        self.interval = interval
+        # Function name -> stage, to tell the stages apart on the event loop thread, where they all run.
+        self.stage_functions = stage_functions
+        self.stages = stages
+        self.threads: {int: str} = {}
+        self.stacks = defaultdict(Counter)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.sample(name, frame)
+
+    def sample(self, name: str, frame):
+        stack = []
+        stage = None
+        while frame is not None:
+            stack.append(frame_name(frame.f_code))
+            stage = self.stage_functions.get(frame.f_code.co_name, stage)
+            frame = frame.f_back
+        stack.reverse()
+        if name == 'loop' and self.stages and stage not in self.stages:
+            return
+        self.stacks[name][';'.join(([stage] if stage else []) + stack)] += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+class StageTimes:
+    # Seconds each stage spent waiting (queue, open circuit and rate limiter), on the network, parsing, in the rest
+    # of its call and in the db thread.
+    def __init__(self):
+        self.seconds = defaultdict(Counter)
+        self.items = Counter()
+
+    def record(self, stage: str, wait: float, network: float, parse: float, call: float):
+        self.items[stage] += 1
+        self.seconds[stage].update({'wait': wait, 'network': network, 'parse': parse,
+                                    'call': max(0.0, call - network - parse)})
+
+    def record_db(self, stage: str, seconds: float):
+        self.seconds[stage]['db'] += seconds
+
+    def report(self) -> str:
+        lines = [f'{"stage":<10}{"items":>8}' + ''.join(f'{f"{part} s":>12}' for part in PARTS)
+                 + ''.join(f'{f"{part} ms/item":>16}' for part in PARTS)]
+        for stage in sorted(self.seconds):
+            items = self.items[stage]
+            seconds = self.seconds[stage]
+            lines.append(f'{stage:<10}{items:>8}' + ''.join(f'{seconds[part]:>12.2f}' for part in PARTS)
+                         + ''.join(f'{seconds[part] * 1000 / items if items else 0:>16.2f}' for part in PARTS))
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    def __init__(self, directory: str, targets: [str], interval: float, allocations: bool,
+                 stage_functions: {str: str}):
+        self.directory = directory
+        # Threads are "loop" and "db"; a stage name profiles the loop thread only while it runs that stage.
+        stages = set(stage_functions.values())
+        self.threads = {target for target in targets if target not in stages}
+        if set(targets) & stages:
+            self.threads.add('loop')
+        self.sampler = StackSampler(interval, stage_functions, set(targets) & stages)
+        self.allocations = allocations
+        self.stage_times = StageTimes()
+        self.started = time.perf_counter()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.allocations:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.threads:
+            self.sampler.start()
+
+    def register(self, name: str):
+        # Called from the thread itself.
+        if name in self.threads:
+            self.sampler.threads[threading.get_ident()] = name
+
+    def stop(self):
+        if self.sampler.is_alive():
+            self.sampler.stop()
+        for name, stacks in self.sampler.stacks.items():
+            self.write_collapsed(f'{name}.collapsed', stacks)
+        if self.allocations:
+            self.write_allocations(tracemalloc.take_snapshot())
+            tracemalloc.stop()
+        report = self.stage_times.report()
+        with open(os.path.join(self.directory, 'stages.txt'), 'w') as stages_file:
+            stages_file.write(report)
+        logger.info(f'Profile of {time.perf_counter() - self.started:.0f}s written to {self.directory}.\n{report}')
+
+    def write_collapsed(self, name: str, stacks: Counter):
+        # One "frame;frame;frame count" line per stack, as flamegraph.pl and speedscope read it.
+        with open(os.path.join(self.directory, name), 'w') as collapsed_file:
+            for stack, count in stacks.most_common():
+                collapsed_file.write(f'{stack} {count}\n')
+
+    def write_allocations(self, snapshot: tracemalloc.Snapshot):
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        statistics = snapshot.statistics('traceback')
+        stacks = Counter()
+        for statistic in statistics:
+            frames = [f'{os.path.basename(frame.filename)}:{frame.lineno}' for frame in statistic.traceback]
+            stacks[';'.join(frames)] += statistic.size
+        self.write_collapsed('allocations.collapsed', stacks)
+        top = '\n'.join(f'{statistic.size / 1024:.0f} KiB in {statistic.count} blocks at {statistic.traceback[-1]}'
+                        for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS])
+        logger.info(f'Largest live allocations:\n{top}')
+
+
+profiler: Optional[Profiler] = None
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from utils import logger
+
+DEFAULT_RETRY_AFTER: float = 1
+# Longest wait a response header can impose. RapidAPI also sends the monthly quota's reset, which can be weeks away.
+MAX_BLOCK: float = 300
+SHORT_WINDOW: float = 60
+RATE_DECREASE: float = .5
+# Share of the configured rate regained per second of successful requests, whatever the rate is.
+RATE_INCREASE: float = .05
+MIN_RATE: float = .1
+
+REMAINING_HEADERS = ['X-RateLimit-Requests-Remaining', 'X-RateLimit-Remaining']
+RESET_HEADERS = ['X-RateLimit-Requests-Reset', 'X-RateLimit-Reset']
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, max_rate: float = None):
+        self.rate = rate
+        self.configured_rate = rate
+        self.burst = burst
+        self.max_rate = max(rate, max_rate or rate)
+        self.tokens = burst
+        self.updated: Optional[float] = None
+        self.blocked_until = 0
+        self.decreased_at: Optional[float] = None
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def refill(self):
+        now = self.now()
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # The lock keeps waiters in FIFO order so a burst of workers is served at the bucket's pace.
+        async with self.lock:
+            while True:
+                self.refill()
+                now = self.updated
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        if seconds > MAX_BLOCK:
+            logger.error(f'Rate limit blocks for {seconds:.0f}s, over the {MAX_BLOCK:.0f}s limit. Quota exhausted.')
+            raise QuotaExhaustedError(f'Rate limit blocks for {seconds:.0f}s.')
+        self.refill()
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, self.updated + seconds)
+
+    def observe(self, status: int, headers, sent: float = None):
+        # sent is the loop time the request went out. A 429 for a request sent before the last decrease was already
+        # answered by it, so a burst of in-flight 429s halves the rate once. Without it, any 429 while blocked is
+        # taken as one of those.
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        remaining = first_header(headers, REMAINING_HEADERS)
+        reset = first_header(headers, RESET_HEADERS)
+
+        if status == 429:
+            if sent is None:
+                stale = self.decreased_at is not None and self.now() < self.blocked_until
+            else:
+                stale = self.decreased_at is not None and sent < self.decreased_at
+            if not stale:
+                self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+                self.decreased_at = self.now()
+                logger.warning(f'Rate limited. Rate: {self.rate:.2f}/s. Retry after: {retry_after}.')
+            self.block(DEFAULT_RETRY_AFTER if retry_after is None else retry_after)
+            return
+        if retry_after is not None:
+            self.block(retry_after)
+
+        if remaining is not None and reset is not None:
+            if remaining <= 0:
+                self.block(reset)
+                logger.warning(f'Rate limit quota exhausted. Blocking for {reset}s.')
+                return
+            if 0 < reset <= SHORT_WINDOW:
+                self.rate = max(MIN_RATE, min(self.max_rate, remaining / reset))
+                return
+        if 200 <= status < 300:
+            # At self.rate responses a second, this regains RATE_INCREASE of the configured rate each second.
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE * self.configured_rate / self.rate)
+
+
+def first_header(headers, names) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_retry_after(value) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class QuotaExhaustedError(Exception):
+    pass
@@ -0,0 +1,79 @@
+import asyncio
+import random
+
+from utils import logger
+
+MAX_ATTEMPTS: int = 8
+RETRY_BASE_DELAY: float = 1
+RETRY_MAX_DELAY: float = 600
+
+STATE_CLOSED = 'CLOSED'
+STATE_OPEN = 'OPEN'
+STATE_HALF_OPEN = 'HALF_OPEN'
+
+FAILURE_THRESHOLD: int = 5
+RESET_TIMEOUT: float = 30
+MAX_RESET_TIMEOUT: float = 600
+
+
+def backoff_delay(attempts: int) -> float:
+    # Exponential backoff with equal jitter so retries of a burst of failures spread out.
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+    @staticmethod
+    def now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def allow(self) -> bool:
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN and self.now() >= self.opened_at + self.reset_timeout:
+            self.state = STATE_HALF_OPEN
+            self.probing = False
+            logger.info(f'Circuit {self.name} half-open.')
+        if self.state == STATE_HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def retry_in(self) -> float:
+        if self.state == STATE_OPEN:
+            remaining = self.opened_at + self.reset_timeout - self.now()
+        else:
+            remaining = RETRY_BASE_DELAY
+        return max(0.0, remaining) + random.uniform(0, RETRY_BASE_DELAY)
+
+    def record_success(self):
+        if self.state != STATE_CLOSED:
+            logger.info(f'Circuit {self.name} closed.')
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.probing = False
+        self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN:
+            self.reset_timeout = min(MAX_RESET_TIMEOUT, self.reset_timeout * 2)
+            self.open()
+        elif self.state == STATE_CLOSED and self.failures >= self.failure_threshold:
+            self.open()
+
+    def open(self):
+        self.state = STATE_OPEN
+        self.opened_at = self.now()
+        self.probing = False
+        logger.warning(f'Circuit {self.name} open for {self.reset_timeout}s after {self.failures} failures.')
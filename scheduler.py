@@ -0,0 +1,73 @@
+import asyncio
+import heapq
+import itertools
+from typing import Callable, Optional
+
+from utils import logger
+
+
+class ScheduledCall:
+    def __init__(self, when: float, sequence: int, callback: Callable, args: tuple, interval: Optional[float]):
+        self.when = when
+        self.sequence = sequence
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.sequence) < (other.when, other.sequence)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    # One heap of timed callbacks drained by a single task, so periodic jobs and delayed retries share one loop
+    # instead of each owning a timer.
+    def __init__(self):
+        self.heap: [ScheduledCall] = []
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    @staticmethod
+    def now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def call_at(self, when: float, callback: Callable, *args, interval: float = None) -> ScheduledCall:
+        call = ScheduledCall(when, next(self.sequence), callback, args, interval)
+        heapq.heappush(self.heap, call)
+        if self.heap[0] is call:
+            self.wakeup.set()
+        return call
+
+    def call_later(self, delay: float, callback: Callable, *args) -> ScheduledCall:
+        return self.call_at(self.now() + delay, callback, *args)
+
+    def call_every(self, interval: float, callback: Callable, *args) -> ScheduledCall:
+        return self.call_at(self.now() + interval, callback, *args, interval=interval)
+
+    def pending(self) -> int:
+        return sum(1 for call in self.heap if not call.cancelled)
+
+    async def run(self):
+        while True:
+            now = self.now()
+            while self.heap and self.heap[0].when <= now:
+                call = heapq.heappop(self.heap)
+                if call.cancelled:
+                    continue
+                try:
+                    call.callback(*call.args)
+                except Exception as e:
+                    logger.exception(f'Scheduled call {call.callback.__name__} failed: {e}')
+                if call.interval is not None and not call.cancelled:
+                    # Collapse missed ticks into one rather than firing them back to back.
+                    call.when = max(call.when + call.interval, now)
+                    heapq.heappush(self.heap, call)
+            self.wakeup.clear()
+            timeout = self.heap[0].when - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
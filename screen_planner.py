@@ -0,0 +1,112 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from typing import Optional
+
+import utils
+
+MAX_TOTAL: int = 5000
+MAX_RESULTS: int = 50
+DEFAULT_FLOOR: float = -1
+# Planned bands aim below MAX_TOTAL so funds listed since last month do not push a band over the limit.
+BAND_TARGET: int = 4500
+PRICE_EPSILON: float = .0001
+
+QUOTE_TYPES = {utils.STATE_MUTUAL_FUND: 'MUTUALFUND', utils.STATE_ETF: 'ETF'}
+
+
+class ScreenBand:
+    def __init__(self, quote_type: str, floor: float, roof: Optional[float] = None, expected: int = None,
+                 done: bool = False):
+        self.quote_type = quote_type
+        self.floor = floor
+        self.roof = roof
+        self.expected = expected
+        self.done = done
+        self.total: Optional[int] = None
+        self.last_price: Optional[float] = None
+        self.last_price_offset = -1
+        self.pages: {int: asyncio.Future} = {}
+        self.items = {}
+
+    def __str__(self):
+        return f'{self.quote_type}:{self.floor}-{self.roof}'
+
+    def to_dict(self):
+        return {'floor': self.floor, 'roof': self.roof, 'expected': self.expected, 'done': self.done}
+
+    @staticmethod
+    def from_dict(quote_type: str, data: dict):
+        return ScreenBand(quote_type, data['floor'], data['roof'], data.get('expected'), data['done'])
+
+    def page(self, offset: int) -> asyncio.Future:
+        if offset not in self.pages:
+            self.pages[offset] = asyncio.get_running_loop().create_future()
+        return self.pages[offset]
+
+    def limit(self) -> int:
+        if self.total is not None:
+            return min(self.total, MAX_TOTAL)
+        if self.expected:
+            return min(self.expected, MAX_TOTAL)
+        return MAX_RESULTS
+
+    def cancel_beyond(self, limit: int):
+        for offset, item in self.items.items():
+            if offset >= limit and not self.page(offset).done():
+                item.cancelled = True
+                self.page(offset).cancel()
+
+    def record(self, offset: int, total: int, prices: [float]):
+        self.total = total
+        if prices and offset > self.last_price_offset:
+            self.last_price = prices[-1]
+            self.last_price_offset = offset
+        future = self.page(offset)
+        if not future.done():
+            future.set_result(total)
+
+    def finish(self, item):
+        # Pages are resolved by record() as soon as they are parsed.
+        pass
+
+    def retry(self, item, delay: float):
+        pass
+
+    def abandon(self, item):
+        _, offset = item.args
+        future = self.page(offset)
+        if not future.done():
+            future.set_exception(ScreenIncompleteError(f'Page {offset} of band {self} was abandoned.'))
+
+    def follow_up(self) -> Optional['ScreenBand']:
+        # Results are sorted by price, so a band holding more than MAX_TOTAL funds continues from the last price
+        # fetched instead of being re-screened with a lower roof.
+        if self.total is None or self.total <= MAX_TOTAL or self.last_price is None:
+            return None
+        if self.last_price <= self.floor:
+            raise ScreenIncompleteError(f'Band {self} holds more than {MAX_TOTAL} funds at a single price.')
+        return ScreenBand(self.quote_type, self.last_price - PRICE_EPSILON, self.roof,
+                          self.total - self.last_price_offset - MAX_RESULTS)
+
+
+def plan_bands(quote_type: str, prices: [float], floor: float = DEFAULT_FLOOR, target: int = BAND_TARGET) -> \
+        [ScreenBand]:
+    # Cuts last month's sorted price distribution into bands of at most `target` funds. The last band is left
+    # open so funds priced above anything seen before are still screened.
+    prices = [price for price in prices if price > floor]
+    bands = []
+    current_floor = floor
+    index = target
+    while index < len(prices):
+        roof = prices[index - 1]
+        if roof > current_floor:
+            expected = bisect_right(prices, roof) - bisect_left(prices, current_floor)
+            bands.append(ScreenBand(quote_type, current_floor, roof, expected))
+            current_floor = roof
+        index += target
+    bands.append(ScreenBand(quote_type, current_floor, None, len(prices) - bisect_right(prices, current_floor)))
+    return bands
+
+
+class ScreenIncompleteError(Exception):
+    pass
@@ -2,260 +2,181 @@ import json
 from typing import Optional
 
 
-# TODO add list structure
-# TODO add dict structure
+# A field is (name, path, convert). Every key of the path but the last steps into a nested object and, when that
+# object is missing, stays on the current one; the last key is read with None for anything missing. Each record's
+# fields are compiled once into a flat __init__ over __slots__, so parsing a response is one function call per record
+# rather than one object per field.
 
-class Response:
-    def __init__(self, api_id, data):
-        self.api_id = api_id
-        try:
-            self.data = data[api_id]
-        except KeyError:
-            self.data = data
+def integer(value) -> Optional[int]:
+    if isinstance(value, dict) and 'raw' in value:
+        value = value['raw']
+    try:
+        return int(value)
+    except TypeError:
+        return None
 
-    def __str__(self):
-        return str(self.data)
-
-    def get_vars(self):
-        var = vars(self).copy()
-        var.pop('api_id')
-        return var
-
-    def to_dict(self):
-        return_dict = {}
-        all_vars = self.get_vars()
-        for var in all_vars:
-            if isinstance(all_vars[var], Response):
-                if isinstance(all_vars[var].to_dict(), dict):
-                    return_dict.update(all_vars[var].to_dict())
-                else:
-                    return_dict[var] = all_vars[var].to_dict()
-            else:
-                if len(all_vars) == 1:
-                    return all_vars[var]
-        return return_dict
-
-
-class DataResponse(Response):
-    def __init__(self, api_id, data):
-        super().__init__(api_id, data)
-        self.api_id = api_id
-        try:
-            self.data = data[api_id]
-        except (KeyError, TypeError):
-            self.data = None
-
-
-class IntegerResponse(DataResponse):
-    def __init__(self, api_id, data):
-        super().__init__(api_id, data)
-        self.get_integer()
-
-    def get_integer(self) -> Optional[int]:
-        if self.data is None:
-            return None
-        if isinstance(self.data, dict) and 'raw' in self.data:
-            self.data = self.data['raw']
-        try:
-            self.data = int(self.data)
-        except TypeError:
-            self.data = None
-
-
-class RealResponse(DataResponse):
-    def __init__(self, api_id, data):
-        super().__init__(api_id, data)
-        self.get_real_number()
-
-    def get_real_number(self) -> Optional[float]:
-        if self.data is None:
-            return None
-        if isinstance(self.data, dict) and 'raw' in self.data:
-            self.data = self.data['raw']
-        try:
-            self.data = float(self.data)
-        except TypeError:
-            self.data = None
-
-
-class TextResponse(DataResponse):
-    def __init__(self, api_id, data):
-        super().__init__(api_id, data)
-        self.get_text()
-
-    def get_text(self):
-        if self.data is None:
-            return None
-        self.data = str(self.data)
-
-
-class ListResponse(DataResponse):
-    def __init__(self, api_id, data, data_function=None):
-        super().__init__(api_id, data)
-        self.data_function = data_function
-        self.get_list()
-
-    def get_list(self):
-        if self.data is None or self.data_function is None:
-            return None
-        new_data = []
-        for item in self.data:
-            new_data.append(self.data_function(item))
-        self.data = new_data
-
-    def to_dict(self):
-        data_set = []
-        for entry in self.data:
-            if isinstance(entry, Response):
-                data_set.append(entry.to_dict())
-            else:
-                data_set.append(entry)
-        return data_set
-
-
-class MSTickerResponse(TextResponse):
-    def __init__(self, api_id, data):
-        super().__init__(api_id, data)
-
-    def get_text(self):
-        if self.data is None:
-            return None
-        self.data = str(self.data).split(':')[-1]
-
-
-class ScreenerResponse(Response):
-    def __init__(self, data):
-        super().__init__('main', data)
-        data = data['finance']['result'][0]
-        self.start = IntegerResponse('start', data)
-        self.count = IntegerResponse('count', data)
-        self.total = IntegerResponse('total', data)
-        self.quotes = ListResponse('quotes', data, Quote)
 
+def real(value) -> Optional[float]:
+    if isinstance(value, dict) and 'raw' in value:
+        value = value['raw']
+    try:
+        return float(value)
+    except TypeError:
+        return None
 
-class Quote(Response):
-    def __init__(self, data):
-        super().__init__('Quotes', data)
-        self.symbol = TextResponse('symbol', data)
-        self.longName = TextResponse('longName', data)
-        self.quoteType = TextResponse('quoteType', data)
-        self.firstTradeDateMilliseconds = IntegerResponse('firstTradeDateMilliseconds', data)
-        self.exchange = TextResponse('exchange', data)
-        self.market = TextResponse('market', data)
-        self.marketCap = IntegerResponse('marketCap', data)
-        self.marketState = TextResponse('marketState', data)
-        self.priceHint = IntegerResponse('priceHint', data)
-        self.priceToBook = RealResponse('priceToBook', data)
-        self.regularMarketChange = RealResponse('regularMarketChange', data)
-        self.regularMarketChangePercent = RealResponse('regularMarketChangePercent', data)
-        self.regularMarketPreviousClose = RealResponse('regularMarketPreviousClose', data)
-        self.regularMarketPrice = RealResponse('regularMarketPrice', data)
-        self.sharesOutstanding = IntegerResponse('sharesOutstanding', data)
-        self.tradeable = TextResponse('tradeable', data)
-        self.triggerable = TextResponse('triggerable', data)
-
-
-class PerformanceIdResponse(Response):
-    def __init__(self, data):
-        super().__init__('main', data)
-        self.id = TextResponse('id', data)
-        self.name = TextResponse('name', data)
-        self.description = TextResponse('description', data)
-        self.exchange = TextResponse('exchange', data)
-        self.performanceId = TextResponse('performanceId', data)
-        self.securityType = TextResponse('securityType', data)
-        self.symbol = TextResponse('ticker', data)
-        self.type = TextResponse('type', data)
-        self.url = TextResponse('url', data)
 
+def text(value) -> Optional[str]:
+    if value is None:
+        return None
+    return str(value)
 
-# region MSFinance Response
-class MSFinanceResponse(Response):
-    def __init__(self, data):
-        super().__init__('main', data)
-        self.detail = Detail(data)
-        self.symbol = MSTickerResponse('RegionAndTicker', data)
 
-
-class Detail(Response):
-    def __init__(self, data):
-        super().__init__('Detail', data)
-        self.starRating = IntegerResponse('StarRating', self.data)
+def ms_ticker(value) -> Optional[str]:
+    if value is None:
+        return None
+    return str(value).split(':')[-1]
 
 
-# endregion
+class Listing:
+    def __init__(self, record=None):
+        self.record = record
 
-# region YHFinance Response
-class YHFinanceResponse(Response):
-    def __init__(self, data):
-        super().__init__('main', data)
-        self.symbol = TextResponse('symbol', data)
-        self.defaultKeyStatistics = DefaultKeyStatistics(data)
-        self.fundPerformance = FundPerformance(data)
-        self.fundProfile = FundProfile(data)
+    def __call__(self, value) -> list:
+        if value is None:
+            return []
+        if self.record is None:
+            return list(value)
+        return [self.record(item) for item in value]
 
 
-class DefaultKeyStatistics(Response):
-    def __init__(self, data):
-        super().__init__('defaultKeyStatistics', data)
-        self.beta3Year = RealResponse('beta3Year', self.data)
-        self.totalAssets = IntegerResponse('totalAssets', self.data)
-        self.fundFamily = TextResponse('fundFamily', self.data)
-        self.percent_yield = RealResponse('yield', self.data)
-        self.category = TextResponse('category', self.data)
+def step(node, key):
+    return node[key] if key in node else node
 
 
-class FundPerformance(Response):
-    def __init__(self, data):
-        super().__init__('fundPerformance', data)
-        self.trailingReturns = TrailingReturns(self.data)
-        self.annualTotalReturns = AnnualTotalReturns(self.data)
+class Record:
+    __slots__ = ()
+    FIELDS: [tuple] = []
+    NAMES: tuple = ()
+    NESTED: tuple = ()
 
+    def values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.NAMES)
 
-class TrailingReturns(Response):
-    def __init__(self, data):
-        super().__init__('trailingReturns', data)
-        self.ytd = RealResponse('ytd', self.data)
-        self.lastBearMkt = RealResponse('lastBearMkt', self.data)
-        self.lastBullMkt = RealResponse('lastBullMkt', self.data)
-        self.oneMonth = RealResponse('oneMonth', self.data)
-        self.threeMonth = RealResponse('threeMonth', self.data)
-        self.oneYear = RealResponse('oneYear', self.data)
-        self.threeYear = RealResponse('threeYear', self.data)
-        self.fiveYear = RealResponse('fiveYear', self.data)
-        self.tenYear = RealResponse('tenYear', self.data)
-
-
-class FundProfile(Response):
-    def __init__(self, data):
-        super().__init__('fundProfile', data)
-        self.feesExpensesInvestment = FeesExpensesInvestment(self.data)
-        self.brokerages = ListResponse('brokerages', self.data)
+    def to_dict(self) -> dict:
+        record_dict = dict(zip(self.NAMES, self.values()))
+        for name in self.NESTED:
+            record_dict[name] = [item.to_dict() if isinstance(item, Record) else item for item in record_dict[name]]
+        return record_dict
 
+    def __str__(self):
+        return f'{type(self).__name__}{self.to_dict()}'
+
+
+def record(name: str, fields: [tuple]) -> type:
+    lines = ['def __init__(self, data):']
+    nodes = {(): 'data'}
+    namespace = {'step': step}
+    for i, (field, path, convert) in enumerate(fields):
+        for depth in range(1, len(path)):
+            if path[:depth] not in nodes:
+                nodes[path[:depth]] = f'node{len(nodes)}'
+                lines.append(f'    {nodes[path[:depth]]} = step({nodes[path[:depth - 1]]}, {path[depth - 1]!r})')
+        node = nodes[path[:-1]]
+        namespace[f'convert{i}'] = convert
+        lines.append(f'    self.{field} = convert{i}({node}.get({path[-1]!r}) if type({node}) is dict else None)')
+    exec('\n'.join(lines), namespace)
+    names = tuple(field for field, _, _ in fields)
+    nested = tuple(field for field, _, convert in fields if isinstance(convert, Listing))
+    return type(name, (Record,), {'__slots__': names, 'FIELDS': fields, 'NAMES': names, 'NESTED': nested,
+                                  '__init__': namespace['__init__']})
+
+
+Quote = record('Quote', [
+    ('symbol', ('symbol',), text),
+    ('longName', ('longName',), text),
+    ('quoteType', ('quoteType',), text),
+    ('firstTradeDateMilliseconds', ('firstTradeDateMilliseconds',), integer),
+    ('exchange', ('exchange',), text),
+    ('market', ('market',), text),
+    ('marketCap', ('marketCap',), integer),
+    ('marketState', ('marketState',), text),
+    ('priceHint', ('priceHint',), integer),
+    ('priceToBook', ('priceToBook',), real),
+    ('regularMarketChange', ('regularMarketChange',), real),
+    ('regularMarketChangePercent', ('regularMarketChangePercent',), real),
+    ('regularMarketPreviousClose', ('regularMarketPreviousClose',), real),
+    ('regularMarketPrice', ('regularMarketPrice',), real),
+    ('sharesOutstanding', ('sharesOutstanding',), integer),
+    ('tradeable', ('tradeable',), text),
+    ('triggerable', ('triggerable',), text)
+])
+
+
+class ScreenerResponse(record('ScreenerResult', [
+    ('start', ('start',), integer),
+    ('count', ('count',), integer),
+    ('total', ('total',), integer),
+    ('quotes', ('quotes',), Listing(Quote))
+])):
+    __slots__ = ()
 
-class FeesExpensesInvestment(Response):
     def __init__(self, data):
-        super().__init__('feesExpensesInvestment', data)
-        self.twelveBOne = RealResponse('twelveBOne', self.data)
+        super().__init__(data['finance']['result'][0])
 
 
-class AnnualTotalReturns(Response):
-    def __init__(self, data):
-        super().__init__('annualTotalReturns', data)
-        self.returns = ListResponse('returns', self.data, AnnualReturn)
+PerformanceIdResponse = record('PerformanceIdResponse', [
+    ('id', ('id',), text),
+    ('name', ('name',), text),
+    ('description', ('description',), text),
+    ('exchange', ('exchange',), text),
+    ('performanceId', ('performanceId',), text),
+    ('securityType', ('securityType',), text),
+    ('symbol', ('ticker',), text),
+    ('type', ('type',), text),
+    ('url', ('url',), text)
+])
 
+PerformanceIdResults = record('PerformanceIdResults', [
+    ('results', ('results',), Listing(PerformanceIdResponse))
+])
 
-class AnnualReturn(Response):
-    def __init__(self, data):
-        super().__init__('Returns', data)
-        self.annualValue = RealResponse('annualValue', self.data)
-        self.year = IntegerResponse('year', self.data)
-
+# region MSFinance Response
+MSFinanceResponse = record('MSFinanceResponse', [
+    ('starRating', ('Detail', 'StarRating'), integer),
+    ('symbol', ('RegionAndTicker',), ms_ticker)
+])
+# endregion
 
+# region YHFinance Response
+AnnualReturn = record('AnnualReturn', [
+    ('annualValue', ('Returns', 'annualValue'), real),
+    ('year', ('Returns', 'year'), integer)
+])
+
+YHFinanceResponse = record('YHFinanceResponse', [
+    ('symbol', ('symbol',), text),
+    ('beta3Year', ('defaultKeyStatistics', 'beta3Year'), real),
+    ('totalAssets', ('defaultKeyStatistics', 'totalAssets'), integer),
+    ('fundFamily', ('defaultKeyStatistics', 'fundFamily'), text),
+    ('percent_yield', ('defaultKeyStatistics', 'yield'), real),
+    ('category', ('defaultKeyStatistics', 'category'), text),
+    ('ytd', ('fundPerformance', 'trailingReturns', 'ytd'), real),
+    ('lastBearMkt', ('fundPerformance', 'trailingReturns', 'lastBearMkt'), real),
+    ('lastBullMkt', ('fundPerformance', 'trailingReturns', 'lastBullMkt'), real),
+    ('oneMonth', ('fundPerformance', 'trailingReturns', 'oneMonth'), real),
+    ('threeMonth', ('fundPerformance', 'trailingReturns', 'threeMonth'), real),
+    ('oneYear', ('fundPerformance', 'trailingReturns', 'oneYear'), real),
+    ('threeYear', ('fundPerformance', 'trailingReturns', 'threeYear'), real),
+    ('fiveYear', ('fundPerformance', 'trailingReturns', 'fiveYear'), real),
+    ('tenYear', ('fundPerformance', 'trailingReturns', 'tenYear'), real),
+    ('returns', ('fundPerformance', 'annualTotalReturns', 'returns'), Listing(AnnualReturn)),
+    ('twelveBOne', ('fundProfile', 'feesExpensesInvestment', 'twelveBOne'), real),
+    ('brokerages', ('fundProfile', 'brokerages'), Listing())
+])
 # endregion
 
 if __name__ == '__main__':
-    # (ScreenerResponse(json.load(open('./tests/defaults/screen_data.json'))).to_dict())
-    print('err' in YHFinanceResponse(json.load(open('./tests/defaults/yh_bad_data.json'))).defaultKeyStatistics.data)
-    # print(MSFinanceResponse(json.load(open('./tests/defaults/ms_get_detail.json'))[0]).to_dict())
-    # print(PerformanceIdResponse(json.load(open('./tests/defaults/perf_id_data.json'))['results'][0]).to_dict())
+    print(ScreenerResponse(json.load(open('./tests/defaults/screen_data.json'))).to_dict()['total'])
+    print(YHFinanceResponse(json.load(open('./tests/defaults/yh_get_summary.json'))).to_dict())
+    print(MSFinanceResponse(json.load(open('./tests/defaults/ms_get_detail.json'))[0]).to_dict())
+    print(PerformanceIdResponse(json.load(open('./tests/defaults/perf_id_data.json'))['results'][0]).to_dict())
@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from mock_api import MockAPI, Universe, Faults
+import pipeline
+
+# Time the db thread gets to write a bad fund and withdraw its jobs. Calls that reached a worker before then are
+# already paid for.
+WITHDRAW_GRACE = 1
+
+
+def benchmark_args(**overrides) -> argparse.Namespace:
+    args = {'settings': {}, 'siblings': 0, 'bad_rate': 0, 'latency': 0, 'latency_sigma': .5, 'rate_429': 0,
+            'rate_5xx': 0, 'rate_err': 0, 'seed': 0, 'yh_port': pipeline.YH_PORT, 'ms_port': pipeline.MS_PORT}
+    return argparse.Namespace(**(args | overrides))
+
+
+class BadFundTest(unittest.TestCase):
+    def test_yh_bad_fund_gets_no_later_ms_calls(self):
+        # Siblings hand funds a performanceId before their yh call, so their perf and ms jobs are queued while it is
+        # in flight. One slow ms worker keeps those jobs waiting long after the yh stage has found the bad funds.
+        args = benchmark_args(siblings=3, bad_rate=.2, latency=.02, latency_sigma=0,
+                              settings={'ms_workers': 1, 'ms_rate': 1000})
+        universe = Universe(300, args.bad_rate, args.siblings, args.seed)
+        api = MockAPI(universe, Faults(args.latency, args.latency_sigma, seed=args.seed))
+        result = asyncio.run(pipeline.run_size(300, args, api))
+        self.assertTrue(result['success'])
+
+        marked_bad = {entry: arrived for arrived, endpoint, entry, _ in api.requests
+                      if endpoint == 'stock/v2/get-summary' and universe.by_symbol[entry].yh_bad}
+        self.assertTrue(marked_bad)
+        late = []
+        for arrived, endpoint, entry, _ in api.requests:
+            if endpoint == 'market/v2/auto-complete':
+                fund = universe.by_symbol.get(entry)
+            elif endpoint == 'stock/get-detail':
+                fund = universe.by_performance_id.get(entry)
+            else:
+                continue
+            if fund is not None and fund.symbol in marked_bad and arrived > marked_bad[fund.symbol] + WITHDRAW_GRACE:
+                late.append((endpoint, entry))
+        self.assertEqual(late, [])
+
+
+class ValidFundsTest(unittest.TestCase):
+    def test_comment_terminated_valid_funds(self):
+        # The stage views nest valid_funds.sql, so a comment closing it must not swallow their ')'. The output query
+        # is the user's own and puts the substitution on its own line.
+        valid_funds_sql = 'SELECT symbol\nFROM funds -- every fund\n-- screened this month\n'
+        output_funds_sql = pipeline.OUTPUT_FUNDS_SQL.replace('({valid_funds_sql})', '(\n{valid_funds_sql}\n)')
+        with mock.patch.object(pipeline, 'VALID_FUNDS_SQL', valid_funds_sql), \
+                mock.patch.object(pipeline, 'OUTPUT_FUNDS_SQL', output_funds_sql):
+            result = asyncio.run(pipeline.run_size(50, benchmark_args()))
+        self.assertTrue(result['success'])
+        self.assertEqual(result['stages']['ms']['funds'], 50)
+        self.assertEqual(result['rows'], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import copy
 import datetime
 import logging
 from logging.handlers import RotatingFileHandler
@@ -19,31 +20,57 @@ _DEFAULT_SETTINGS = {"api_key": "",
                      "send_start": [""],
                      "send_complete": [""],
                      "last_month_ran": -1,
-                     "headers": [""]
+                     "headers": [""],
+                     "yh_workers": 5,
+                     "ms_workers": 5,
+                     "yh_rate": 4,
+                     "yh_burst": 4,
+                     "yh_max_rate": 8,
+                     "ms_rate": 4,
+                     "ms_burst": 4,
+                     "ms_max_rate": 8,
+                     "screen_window": 10,
+                     "db_batch_size": 500,
+                     "db_batch_latency": .25,
+                     "parse_processes": 0,
+                     "http_cache_bytes": 256 * 1024 * 1024,
+                     "yh_base_url": "https://yh-finance.p.rapidapi.com",
+                     "ms_base_url": "https://ms-finance.p.rapidapi.com",
+                     "metrics_interval": 5,
+                     "profile_threads": [],
+                     "profile_interval": .005,
+                     "profile_allocations": False
                      }
 
 STATE_READY = 'READY'
+STATE_SCREENING = 'SCREENING'
 STATE_MUTUAL_FUND = 'MUTUAL_FUND'
 STATE_ETF = 'ETF'
 STATE_FINISHED = 'FINISHED'
 
 PROGRESS_FILE = DATA_DIR + '/progress.json'
-_DEFAULT_PROGRESS = {"screen_state": "READY",
-                     "offset": 0,
-                     "floor": -1,
+_DEFAULT_PROGRESS = {"screen": {STATE_MUTUAL_FUND: {"state": STATE_READY, "bands": []},
+                                STATE_ETF: {"state": STATE_READY, "bands": []}},
                      "yh_api_calls": 0,
                      "ms_api_calls": 0
                      }
 
 VALID_FUNDS_FILE = DATA_DIR + '/valid_funds.sql'
+FILTERS_FILE = DATA_DIR + '/filters.json'
 OUTPUT_FUNDS_FILE = DATA_DIR + '/output_funds.sql'
 
 TICKERS_FILE = DATA_DIR + '/tickers.csv'
 
+HTTP_CACHE_FILE = DATA_DIR + '/http_cache.db'
+
+METRICS_FILE = DATA_DIR + '/metrics.prom'
+PROFILE_DIR = DATA_DIR + '/profile'
+
 _MAKE_DIRS = [LOG_DIR, DATA_DIR]
 _MAKE_FILES = [(SETTINGS_FILE, _DEFAULT_SETTINGS),
                (PROGRESS_FILE, _DEFAULT_PROGRESS),
                (VALID_FUNDS_FILE, None),
+               (FILTERS_FILE, []),
                (OUTPUT_FUNDS_FILE, None),
                (TICKERS_FILE, None)]
 
@@ -59,14 +86,17 @@ for make_file in _MAKE_FILES:
             json.dump(defaults, new_file, indent=4)
 
 with open(SETTINGS_FILE) as settings_file:
-    settings = json.load(settings_file)
+    settings = _DEFAULT_SETTINGS | json.load(settings_file)
 
 with open(PROGRESS_FILE) as progress_file:
-    progress = json.load(open(PROGRESS_FILE))
+    progress = copy.deepcopy(_DEFAULT_PROGRESS) | json.load(progress_file)
 
 with open(VALID_FUNDS_FILE) as valid_funds_file:
     valid_funds = valid_funds_file.read()
 
+with open(FILTERS_FILE) as filters_file:
+    filters = json.load(filters_file)
+
 with open(OUTPUT_FUNDS_FILE) as output_funds_file:
     output_funds = output_funds_file.read()
 
@@ -82,7 +112,7 @@ def dump_settings():
 
 def reset_progress():
     global progress
-    progress = _DEFAULT_PROGRESS
+    progress = copy.deepcopy(_DEFAULT_PROGRESS)
     dump_progress()
 
 